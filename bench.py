@@ -0,0 +1,199 @@
+"""Нагрузочный прогон бота на локальных заглушках Telegram и Gemini.
+
+Запуск:
+    python bench.py --updates 200 --photos 0.3 --gemini-latency 1.5
+    python bench.py --engine async --stream --gemini-429 0.05 --env WORKERS=16
+
+Бот стартует отдельным процессом (python main.py) в режиме опроса: апдейты
+отдаются ему через getUpdates фейка Telegram, ответы Gemini — из fake_gemini.
+В конце печатаются апдейты/с, p50/p99 задержки от постановки апдейта до
+последнего сообщения с ответом и пиковая память бота (вместе с пулом картинок).
+Конец прогона определяется по /metrics бота: все апдейты обработаны, очереди пусты.
+При --chats меньше --updates задержка считается по последнему апдейту каждого чата.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fake_gemini
+import fake_telegram
+
+def percentile(values, p):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def rss_kb(pid):
+    """Текущая память процесса и всех его детей (Linux /proc), КБ"""
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except (OSError, StopIteration):
+        return total
+    return total + sum(rss_kb(c) for c in children)
+
+def make_updates(n, chats, photos, size):
+    """Синтетический трафик: текст и фото вперемешку, все задачи разные (кэш не помогает)"""
+    updates = []
+    for i in range(n):
+        msg = {"message_id": i + 1, "chat": {"id": 1000000 + i % chats}}
+        if random.random() < photos:
+            msg["photo"] = [{"file_id": f"photo{i}", "width": size[0], "height": size[1]}]
+            msg["caption"] = f"Реши задачу №{i}"
+        else:
+            msg["text"] = f"Реши: {i} + {i * 7} = ?"
+        updates.append({"update_id": i + 1, "message": msg})
+    return updates
+
+def wait_http(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def scrape(port):
+    """/metrics бота -> {строка метрики с метками: значение}"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r:
+            lines = r.read().decode().splitlines()
+    except OSError:
+        return {}
+    return {name: float(value) for name, _, value in (l.rpartition(" ") for l in lines)
+            if name.startswith("tggb_")}
+
+def processed(m, n):
+    if "tggb_queue_pending" in m:
+        # QUEUE_DB: часть апдейтов обработали другие процессы, их счётчиков здесь нет
+        return n - int(m["tggb_queue_pending"])
+    return int(sum(v for k, v in m.items() if k.startswith("tggb_updates_total")))
+
+def finished(m, n, chats):
+    if processed(m, n) < n or m.get("tggb_dispatch_pending") or m.get("tggb_send_pending"): return False
+    if "tggb_queue_pending" not in m: return True
+    # Воркеры других процессов ещё могут дописывать ответы — ждём ответ в каждом чате и секунду тишины
+    with fake_telegram.sent_lock:
+        last = [ev[-1][0] for ev in fake_telegram.replies.values() if ev]
+    return len(last) >= chats and time.time() - max(last) > 1.0
+
+def latencies(pushed_at):
+    """Задержка чата: от постановки его последнего апдейта до последнего сообщения бота в нём"""
+    with fake_telegram.sent_lock:
+        last = {chat: ev[-1][0] for chat, ev in fake_telegram.replies.items() if ev}
+    return {chat: last[chat] - t for chat, t in pushed_at.items() if chat in last}, last
+
+def main():
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон бота на заглушках")
+    ap.add_argument("--updates", type=int, default=100)
+    ap.add_argument("--chats", type=int, default=0, help="сколько разных чатов (0 — по чату на апдейт)")
+    ap.add_argument("--photos", type=float, default=0.3, help="доля апдейтов с фото")
+    ap.add_argument("--photo-size", default="2560x1920", help="размер фото WxH")
+    ap.add_argument("--rate", type=float, default=0.0, help="апдейтов в секунду (0 — все сразу)")
+    ap.add_argument("--engine", choices=("threads", "async"), default="threads")
+    ap.add_argument("--stream", action="store_true", help="STREAM_ANSWERS=1")
+    ap.add_argument("--tg-latency", type=float, default=0.02)
+    ap.add_argument("--tg-429", type=float, default=0.0)
+    ap.add_argument("--gemini-latency", type=float, default=1.0)
+    ap.add_argument("--gemini-jitter", type=float, default=0.5)
+    ap.add_argument("--gemini-429", type=float, default=0.0)
+    ap.add_argument("--gemini-5xx", type=float, default=0.0)
+    ap.add_argument("--model-latency", action="append", default=[], help="модель=секунды для fake_gemini")
+    ap.add_argument("--answer-size", type=int, default=1500)
+    ap.add_argument("--env", action="append", default=[], help="KEY=VALUE для бота (можно несколько)")
+    ap.add_argument("--tg-port", type=int, default=8091)
+    ap.add_argument("--gemini-port", type=int, default=8092)
+    ap.add_argument("--bot-port", type=int, default=8093)
+    ap.add_argument("--timeout", type=float, default=300)
+    ap.add_argument("--log", default=os.devnull, help="куда писать вывод бота")
+    ap.add_argument("--json", action="store_true", help="последней строкой — результат в JSON")
+    args = ap.parse_args()
+
+    size = tuple(int(x) for x in args.photo_size.lower().split("x"))
+    fake_telegram.serve(args.tg_port, photo=fake_telegram.sample_jpeg(size, noise=True),
+                        latency=args.tg_latency, rate_429=args.tg_429, verbose=False)
+    fake_gemini.serve(args.gemini_port, latency=args.gemini_latency, jitter=args.gemini_jitter,
+                      rate_429=args.gemini_429, rate_5xx=args.gemini_5xx, answer_size=args.answer_size, chunks=5,
+                      chunk_delay=0.1, model_latency={k: float(v) for k, v in (kv.split("=", 1) for kv in args.model_latency)})
+
+    tmp = tempfile.mkdtemp(prefix="tggb-bench-")
+    env = dict(os.environ, TELEGRAM_TOKEN="bench", GEMINI_API_KEY="bench", KEY_RPM="1000000",
+               TELEGRAM_API=f"http://127.0.0.1:{args.tg_port}", GEMINI_API=f"http://127.0.0.1:{args.gemini_port}",
+               PORT=str(args.bot_port), WEBHOOK_URL="", CACHE_DIR="", KEYSTORE_DB=os.path.join(tmp, "keys.db"),
+               BOT_ENGINE=args.engine, STREAM_ANSWERS="1" if args.stream else "0", PYTHONUNBUFFERED="1")
+    env.update(kv.split("=", 1) for kv in args.env)
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(args.log, "w") as out:
+        bot = subprocess.Popen([sys.executable, os.path.join(here, "main.py")], env=env, cwd=tmp,
+                               stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        if not wait_http(f"http://127.0.0.1:{args.bot_port}/", 60):
+            sys.exit("🛑 Бот не поднялся (см. --log)")
+        base_rss = rss_kb(bot.pid)
+
+        updates = make_updates(args.updates, args.chats or args.updates, args.photos, size)
+        pushed_at = {}
+        start = time.time()
+        peak_rss = base_rss
+        for i, upd in enumerate(updates):
+            if args.rate:
+                time.sleep(max(0.0, start + i / args.rate - time.time()))
+            pushed_at[upd["message"]["chat"]["id"]] = time.time()
+            fake_telegram.push([upd])
+        print(f"🧪 Поставлено апдейтов: {len(updates)} ({args.engine}, stream={args.stream})")
+
+        while time.time() - start < args.timeout and bot.poll() is None:
+            peak_rss = max(peak_rss, rss_kb(bot.pid))
+            m = scrape(args.bot_port)
+            if finished(m, len(updates), len(pushed_at)):
+                break
+            time.sleep(0.2)
+        lat, done = latencies(pushed_at)
+        m = scrape(args.bot_port)
+        counters = [f"{k} {v:g}" for k, v in sorted(m.items())
+                    if k.startswith(("tggb_updates_total", "tggb_gemini_responses_total", "tggb_telegram_calls_total",
+                                     "tggb_gemini_hedge", "tggb_gemini_retries_total", "tggb_breaker"))]
+    finally:
+        try:
+            os.killpg(bot.pid, signal.SIGTERM)
+        except (OSError, AttributeError):
+            bot.terminate()
+        bot.wait()
+
+    elapsed = (max(done.values()) - start) if done else 0.0
+    values = list(lat.values())
+    done_n = processed(m, len(updates))
+    result = {
+        "updates": len(updates), "processed": done_n, "chats_answered": len(done),
+        "updates_per_s": round(done_n / elapsed, 2) if elapsed else 0.0,
+        "p50_s": round(percentile(values, 50), 3), "p99_s": round(percentile(values, 99), 3),
+        "max_s": round(max(values, default=0.0), 3),
+        "rss_base_mb": round(base_rss / 1024, 1), "rss_peak_mb": round(peak_rss / 1024, 1),
+        "gemini_requests": fake_gemini.FakeGemini.requests, "gemini_uploads": fake_gemini.FakeGemini.uploads,
+        "gemini_mb_in": round(fake_gemini.FakeGemini.bytes_in / 2 ** 20, 1),
+    }
+    print(f"✅ Обработано: {done_n}/{len(updates)} апдейтов за {elapsed:.2f} с "
+          f"→ {result['updates_per_s']} апдейтов/с (ответы в {len(done)}/{len(pushed_at)} чатах)")
+    print(f"⏱ Задержка: p50={result['p50_s']} с, p99={result['p99_s']} с, max={result['max_s']} с")
+    print(f"🧠 Память бота: {result['rss_base_mb']} МБ на старте, пик {result['rss_peak_mb']} МБ")
+    print(f"📡 Запросов в Gemini: {result['gemini_requests']}, загрузок файлов: {result['gemini_uploads']}, "
+          f"принято {result['gemini_mb_in']} МБ")
+    for line in counters:
+        print(f"   {line}")
+    if args.json:
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
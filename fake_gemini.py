@@ -0,0 +1,145 @@
+"""Локальная заглушка Gemini API (generateContent и streamGenerateContent).
+
+Запуск:
+    python fake_gemini.py --port 8082 --latency 2 --chunks 20 --chunk-delay 0.3
+    GEMINI_API=http://localhost:8082 STREAM_ANSWERS=1 python main.py
+
+streamGenerateContent?alt=sse отдаёт ответ кусками (chunked SSE),
+generateContent — целиком после задержки. --rate-429 и --rate-5xx включают случайные
+429 и 503, --model-latency задаёт задержку отдельной модели (проверка хеджирования),
+--model-answer — её готовый ответ (например, отказ — проверка перехода на основную модель).
+POST /upload/v1beta/files принимает картинку (Files API); запрос со ссылкой
+на незагруженный файл получает 404, как после истечения файла.
+GET /v1beta/models/<модель> отдаёт описание модели (им бот прогревает соединение).
+POST /v1beta/cachedContents создаёт кэш контекста (--refuse-context — отказ 400,
+как у настоящего Gemini на слишком короткий промпт).
+"""
+import argparse
+import json
+import random
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+class FakeGemini(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 1.0                # до первого байта ответа
+    jitter = 0.0                 # + случайно от 0 до jitter секунд
+    chunks = 10
+    chunk_delay = 0.2
+    answer_size = 1500
+    rate_429 = 0.0
+    rate_5xx = 0.0
+    model_latency = {}           # модель -> своя задержка вместо latency
+    model_answer = {}            # модель -> свой текст ответа
+    requests = 0
+    uploads = 0
+    bytes_in = 0                 # сколько байт тел запросов пришло (загрузки + генерация)
+    files = set()
+    contexts = set()
+    refuse_context = False
+
+    def log_message(self, *args):
+        pass
+
+    def answer_text(self):
+        base = "**Дано:** условие задачи.\n**Решение:** шаг за шагом. **Ответ:** 42.\n"
+        return (base * (self.answer_size // len(base) + 1))[:self.answer_size]
+
+    def send_json(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        name = self.path.split("?", 1)[0].split("/v1beta/", 1)[-1]
+        if not name.startswith("models/"):
+            return self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": f"{name} not found"}})
+        self.send_json(200, {"name": name, "inputTokenLimit": 1048576, "outputTokenLimit": 8192})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        FakeGemini.bytes_in += len(body)
+        if self.path.startswith("/upload/"):
+            FakeGemini.uploads += 1
+            name = f"files/f{FakeGemini.uploads}"
+            FakeGemini.files.add(name)
+            host = self.headers.get("Host", "127.0.0.1")
+            return self.send_json(200, {"file": {"name": name, "uri": f"http://{host}/v1beta/{name}",
+                                                 "mimeType": self.headers.get("Content-Type"), "state": "ACTIVE",
+                                                 "sizeBytes": str(len(body))}})
+        if self.path.startswith("/v1beta/cachedContents"):
+            if self.refuse_context:
+                return self.send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                                      "message": "Cached content is too small"}})
+            name = f"cachedContents/c{len(FakeGemini.contexts) + 1}"
+            FakeGemini.contexts.add(name)
+            return self.send_json(200, {"name": name, "model": json.loads(body).get("model")})
+        FakeGemini.requests += 1
+        req = json.loads(body)
+        if req.get("cachedContent") and req["cachedContent"] not in self.contexts:
+            return self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": "Cached content not found"}})
+        for part in req["contents"][0]["parts"]:
+            uri = part.get("file_data", {}).get("file_uri")
+            if uri and uri.split("/v1beta/", 1)[-1] not in self.files:
+                return self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND",
+                                                      "message": f"File {uri} not found"}})
+        if random.random() < self.rate_429:
+            return self.send_json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                                  "details": [{"retryDelay": "5s"}]}})
+        if random.random() < self.rate_5xx:
+            return self.send_json(503, {"error": {"code": 503, "status": "UNAVAILABLE", "message": "The model is overloaded"}})
+        model = self.path.split("/models/", 1)[-1].split(":", 1)[0]
+        time.sleep(self.model_latency.get(model, self.latency) + random.uniform(0, self.jitter))
+        text = self.model_answer.get(model) or self.answer_text()
+        usage = {"promptTokenCount": len(body) // 4, "candidatesTokenCount": len(text) // 4}
+        if ":streamGenerateContent" not in self.path:
+            return self.send_json(200, {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = max(1, len(text) // self.chunks)
+        for i in range(0, len(text), step):
+            event = {"candidates": [{"content": {"parts": [{"text": text[i:i + step]}]}}]}
+            if i + step >= len(text): event["usageMetadata"] = usage
+            data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+def serve(port, **opts):
+    for name, value in opts.items():
+        setattr(FakeGemini, name, value)
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeGemini)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Заглушка Gemini API")
+    ap.add_argument("--port", type=int, default=8082)
+    ap.add_argument("--latency", type=float, default=1.0)
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--chunks", type=int, default=10)
+    ap.add_argument("--chunk-delay", type=float, default=0.2)
+    ap.add_argument("--answer-size", type=int, default=1500)
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    ap.add_argument("--rate-5xx", type=float, default=0.0)
+    ap.add_argument("--model-latency", action="append", default=[], help="модель=секунды (можно несколько)")
+    ap.add_argument("--model-answer", action="append", default=[], help="модель=текст ответа (можно несколько)")
+    ap.add_argument("--refuse-context", action="store_true")
+    args = ap.parse_args()
+
+    serve(args.port, latency=args.latency, jitter=args.jitter, chunks=args.chunks, chunk_delay=args.chunk_delay,
+          answer_size=args.answer_size, rate_429=args.rate_429, rate_5xx=args.rate_5xx,
+          model_latency={k: float(v) for k, v in (kv.split("=", 1) for kv in args.model_latency)},
+          model_answer=dict(kv.split("=", 1) for kv in args.model_answer),
+          refuse_context=args.refuse_context)
+    print(f"🧪 Заглушка Gemini на http://127.0.0.1:{args.port}")
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,151 @@
+"""Локальный фейк Telegram Bot API для проверки вебхука.
+
+Запуск:
+    python fake_telegram.py updates.jsonl --webhook http://localhost:8080/webhook
+    TELEGRAM_API=http://localhost:8081 WEBHOOK_URL=http://localhost:8080 python main.py
+
+Фейк отвечает на вызовы Bot API (sendMessage, getFile, setWebhook, ...)
+и по очереди POST-ит записанные апдейты (по одному JSON на строку) в вебхук бота.
+Для режима опроса апдейты кладутся в очередь через push() и отдаются в getUpdates
+(так работает bench.py).
+"""
+import argparse
+import io
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock, Condition
+from urllib.parse import urlsplit, parse_qs
+
+sent = []
+sent_lock = Lock()
+replies = {}                     # chat_id -> [(время, sendMessage|editMessageText), ...]
+inbox = []                       # апдейты для getUpdates
+inbox_cond = Condition()
+
+def sample_jpeg(size=(1280, 960), noise=False):
+    """Картинка для ответа на скачивание файла (noise=True — шум, плохо жмётся, как фото)"""
+    from PIL import Image
+    if noise:
+        img = Image.frombytes("RGB", size, random.randbytes(size[0] * size[1] * 3))
+    else:
+        img = Image.new("RGB", size, "white")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def push(updates):
+    """Положить апдейты в очередь getUpdates"""
+    with inbox_cond:
+        inbox.extend(updates)
+        inbox_cond.notify_all()
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    photo = b""
+    latency = 0.0                # задержка каждого вызова Bot API
+    rate_429 = 0.0               # доля sendMessage/editMessageText, отвеченных 429
+    verbose = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, ctype="application/json", code=200):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/file/"):
+            time.sleep(self.latency)
+            return self.reply(self.photo, "image/jpeg")
+        self.handle_method()
+
+    def do_POST(self):
+        self.handle_method()
+
+    def handle_method(self):
+        method = self.path.split("?")[0].rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+        body.update({k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()})
+        if method == "getUpdates":
+            return self.reply({"ok": True, "result": self.take_updates(body)})
+        time.sleep(self.latency)
+        if method == "getFile":
+            return self.reply({"ok": True, "result": {"file_path": "photos/file_0.jpg"}})
+        if method in ("sendMessage", "editMessageText"):
+            if random.random() < self.rate_429:
+                return self.reply({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                   "parameters": {"retry_after": 1}}, code=429)
+            with sent_lock:
+                sent.append(body)
+                replies.setdefault(body.get("chat_id"), []).append((time.time(), method))
+            if self.verbose:
+                print(f"💬 {method} -> {body.get('chat_id')}: {str(body.get('text', ''))[:60]!r}")
+            return self.reply({"ok": True, "result": {"message_id": len(sent), "chat": {"id": body.get("chat_id")}}})
+        self.reply({"ok": True, "result": True, "description": f"fake {method}"})
+
+    def take_updates(self, params):
+        """Long polling: апдейты с update_id >= offset, иначе ждём до timeout (в режиме вебхука — пусто)"""
+        offset = int(params.get("offset") or 0)
+        deadline = time.time() + min(float(params.get("timeout") or 1), 20)
+        with inbox_cond:
+            # Подтверждённые (update_id < offset) больше не отдаём
+            inbox[:] = [u for u in inbox if u["update_id"] >= offset]
+            while not inbox and time.time() < deadline:
+                inbox_cond.wait(deadline - time.time())
+            return inbox[:int(params.get("limit") or 100)]
+
+def replay(path, webhook, secret=None, delay=0.0):
+    """POST записанных апдейтов в вебхук бота"""
+    with open(path, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    for upd in updates:
+        req = urllib.request.Request(webhook, data=json.dumps(upd).encode(), method="POST",
+                                     headers={"Content-Type": "application/json"})
+        if secret:
+            req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+        for attempt in range(20):
+            try:
+                with urllib.request.urlopen(req, timeout=10) as r:
+                    print(f"📨 update {upd.get('update_id')} -> {r.status}")
+                break
+            except urllib.error.URLError as e:
+                # Бот ещё стартует — ждём, пока поднимется его веб-сервер
+                if attempt == 19 or not isinstance(getattr(e, "reason", None), ConnectionRefusedError): raise
+                time.sleep(0.5)
+        time.sleep(delay)
+    return len(updates)
+
+def serve(port, photo=None, **opts):
+    for name, value in opts.items():
+        setattr(FakeBotApi, name, value)
+    FakeBotApi.photo = photo if photo is not None else sample_jpeg()
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeBotApi)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Фейк Telegram Bot API + проигрыватель апдейтов")
+    ap.add_argument("updates", help="JSONL с записанными апдейтами")
+    ap.add_argument("--webhook", default="http://localhost:8080/webhook")
+    ap.add_argument("--secret", default=None)
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--delay", type=float, default=0.0)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка каждого вызова Bot API")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="доля отправок, отвеченных 429")
+    ap.add_argument("--wait", type=float, default=30.0, help="сколько ждать ответов бота")
+    args = ap.parse_args()
+
+    serve(args.port, latency=args.latency, rate_429=args.rate_429)
+    print(f"🧪 Фейк Bot API на http://127.0.0.1:{args.port}")
+    n = replay(args.updates, args.webhook, args.secret, args.delay)
+    time.sleep(args.wait)
+    print(f"✅ Отправлено апдейтов: {n}, получено сообщений от бота: {len(sent)}")
@@ -1,170 +1,1624 @@
 import os
+import re
+import sys
 import time
-import requests
+import random
+import signal
+import importlib.util
+import asyncio
 import base64
 import io
-import datetime
-from PIL import Image
+import contextvars
+import atexit
+import hashlib
+import heapq
+import json
+import sqlite3
+import socket
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeout
+from cryptography.fernet import Fernet, InvalidToken
 from dotenv import load_dotenv
-from flask import Flask
-from threading import Thread
+from flask import Flask, request, Response
+from threading import Thread, Lock, BoundedSemaphore, Condition, Event
+from queue import Queue, Full, Empty
+from collections import deque, OrderedDict
+from bisect import bisect_left
+
+def lazy_import(name):
+    """Модуль грузится при первом обращении к атрибуту: потоковому движку не нужен httpx, async — requests,
+    а процессу без фото — Pillow. Первое обращение делаем из главного потока (LazyLoader не потокобезопасен)"""
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+requests = lazy_import("requests")
+httpx = lazy_import("httpx")
+Image = lazy_import("PIL.Image")
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
 load_dotenv()
 app = Flask('')
 
-# Хранилище личных ключей
-user_keys = {}
+# --- МЕТРИКИ ---
+class Metrics:
+    """Счётчики и гистограммы в текстовом формате Prometheus (GET /metrics)"""
+    SECONDS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45, 90)
+    BYTES = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}           # (имя, метки) -> значение
+        self.hists = {}              # (имя, метки) -> [границы, счётчики, сумма, количество]
+        self.collectors = []         # функции -> [(имя, метки, значение)] на момент запроса
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        i = bisect_left(buckets, value)
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None:
+                h = self.hists[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            if i < len(buckets): h[1][i] += 1
+            h[2] += value
+            h[3] += 1
+
+    def collect(self, fn):
+        self.collectors.append(fn)
+
+    def render(self):
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            hists = sorted(self.hists.items(), key=lambda kv: kv[0])
+            hists = [(k, [h[0], list(h[1]), h[2], h[3]]) for k, h in hists]
+        for (name, labels), value in counters:
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), (buckets, counts, total, n) in hists:
+            acc = 0
+            for le, c in zip(buckets, counts):
+                acc += c
+                lines.append(f"{name}_bucket{fmt(labels + (('le', le),))} {acc}")
+            lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {n}")
+            lines.append(f"{name}_sum{fmt(labels)} {total:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {n}")
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn():
+                    lines.append(f"{name}{fmt(tuple(sorted(labels.items())))} {value}")
+            except Exception as e:
+                lines.append(f"# collector error: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# --- ЛИЧНЫЕ КЛЮЧИ (BYOK) ---
+class KeyStore:
+    """Личные ключи в SQLite (зашифрованы Fernet) + кэш в памяти для call_ai"""
+    def __init__(self, db_path, secret, cache_size=50000, ttl=60):
+        self.db_path = db_path
+        # Любая строка-секрет превращается в 32-байтовый ключ Fernet
+        self.fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest()))
+        self.cache = OrderedDict()   # chat_id -> (ключ или None, когда проверяли)
+        self.cache_size = cache_size
+        # И ключ, и «ключа нет» перепроверяем: его мог сменить или отозвать другой процесс (QUEUE_WORKERS)
+        self.ttl = ttl
+        self.lock = Lock()
+        self.db = None
+
+    def _conn(self):
+        # Подключаемся лениво: дочерние процессы пула картинок базу не открывают
+        if self.db is None:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS user_keys (chat_id INTEGER PRIMARY KEY, token BLOB, updated REAL)")
+            self.db.commit()
+        return self.db
+
+    def get(self, chat_id, default=None):
+        if chat_id is None: return default
+        with self.lock:
+            hit = self.cache.get(chat_id)
+            if hit is not None and time.monotonic() - hit[1] < self.ttl:
+                self.cache.move_to_end(chat_id)
+                return hit[0] or default
+            row = self._conn().execute("SELECT token FROM user_keys WHERE chat_id = ?", (chat_id,)).fetchone()
+            value = None
+            if row:
+                try:
+                    value = self.fernet.decrypt(row[0]).decode()
+                except InvalidToken:
+                    log(f"🛑 [KEYS] Ключ {chat_id} не расшифрован (сменился KEYSTORE_SECRET?)")
+            self._remember(chat_id, value or None)
+            return value or default
+
+    def __setitem__(self, chat_id, api_key):
+        token = self.fernet.encrypt(api_key.encode())
+        with self.lock:
+            self._conn().execute("INSERT OR REPLACE INTO user_keys VALUES (?, ?, ?)", (chat_id, token, time.time()))
+            self.db.commit()
+            self._remember(chat_id, api_key)
+
+    def __delitem__(self, chat_id):
+        with self.lock:
+            self._conn().execute("DELETE FROM user_keys WHERE chat_id = ?", (chat_id,))
+            self.db.commit()
+            self.cache.pop(chat_id, None)
+
+    def _remember(self, chat_id, value):
+        self.cache[chat_id] = (value, time.monotonic())
+        self.cache.move_to_end(chat_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+# Хранилище личных ключей (переживает редеплой)
+user_keys = KeyStore(os.environ.get("KEYSTORE_DB", "user_keys.db"),
+                     os.getenv("KEYSTORE_SECRET") or f"tggb:{os.getenv('TELEGRAM_TOKEN', '')}")
+
+# Адрес Bot API (можно подменить на локальный фейк для тестов)
+TELEGRAM_API = os.getenv("TELEGRAM_API", "https://api.telegram.org")
+GEMINI_API = os.getenv("GEMINI_API", "https://generativelanguage.googleapis.com")
+# Вебхук: если задан публичный адрес, long polling не используется
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Апдейты, пришедшие через вебхук, ждут здесь диспетчера
+update_queue = Queue(maxsize=int(os.environ.get("WEBHOOK_QUEUE", 1000)))
 
 @app.route('/')
 def home():
-    # Мгновенный ответ для Health Check Render
+    # Health Check Render: 200 только после прогрева, на время остановки снова 503 — трафик уходит новому инстансу
+    if not lifecycle.ready.is_set():
+        return ("🛬 Останавливаюсь" if lifecycle.stopping.is_set() else "⏳ Запускаюсь"), 503
     return "🚀 Бот онлайн. Деплой успешен!"
 
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    # Telegram присылает секрет в заголовке — чужие POST отсекаем
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return "forbidden", 403
+    upd = request.get_json(silent=True)
+    if not upd or "update_id" not in upd:
+        return "bad update", 400
+    if lifecycle.stopping.is_set():
+        # Идёт остановка: Telegram повторит доставку уже новому инстансу
+        return "stopping", 503
+    try:
+        update_queue.put_nowait(upd)
+    except Full:
+        # Не-2xx ответ: Telegram повторит доставку позже
+        return "busy", 503
+    return "ok"
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 def run_web():
     port = int(os.environ.get("PORT", 8080))
     # Передача host='0.0.0.0' критична для Render
     app.run(host='0.0.0.0', port=port)
 
-def log(message):
-    ts = datetime.datetime.now().strftime("%H:%M:%S")
-    print(f"[{ts}] {message}")
+# --- ЛОГИ ---
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")      # json — запись на строку для сборщика логов, text — как раньше
+LOG_SAMPLE = float(os.environ.get("LOG_SAMPLE", 1.0))  # доля апдейтов, чьи записи пишутся всегда
+LOG_SLOW = float(os.environ.get("LOG_SLOW", 10.0))     # апдейт дольше стольких секунд пишется целиком
 
-# --- КЛАСС БОТА (БЕЗ ОШИБОК ОТСТУПОВ) ---
-class UltraGdzBot:
-    def __init__(self):
-        log("⚙️ Сборка системы...")
-        self.tg_token = os.getenv("TELEGRAM_TOKEN")
-        self.admin_key = os.getenv("GEMINI_API_KEY") 
-        self.tg_url = f"https://api.telegram.org/bot{self.tg_token}/"
-        self.model_name = "models/gemini-2.0-flash" 
-        self.offset = 0
-        self.session = requests.Session()
-        
-        self.system_instructions = (
-            "Ты — элитный ИИ-репетитор. Решай всё по фото.\n"
-            "Формат: **Дано**, **Решение**, **Ответ**.\n"
-            "Добавляй советы для ЕГЭ и YouTube темы."
-        )
+class LogWriter:
+    """Запись логов в фоновом потоке: log() только кладёт запись в очередь, время форматируется и stdout
+    пишется пачками не в потоке апдейта. Очередь полна (stdout не успевает) — запись теряется и считается,
+    а не тормозит обработку"""
+    def __init__(self, fmt="json", max_queue=10000):
+        self.fmt = fmt
+        self.queue = Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.thread = None
+        self.lock = Lock()
 
-    def get_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "📚 Проще", "callback_data": "mode_simple"}, 
-                 {"text": "📝 ЕГЭ", "callback_data": "mode_ege"}],
-                [{"text": "🔑 Свой ключ", "callback_data": "tutorial"}]
-            ]
-        }
+    def put(self, record):
+        if self.thread is None: self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
 
-    def call_ai(self, text, img_bytes=None, user_id=None, sub_mode="standard"):
-        active_key = user_keys.get(user_id, self.admin_key)
-        
-        instruction = self.system_instructions
-        if sub_mode == "mode_simple": instruction += "\nУпрости объяснение."
-        elif sub_mode == "mode_ege": instruction += "\nОформи по критериям ЕГЭ."
-
-        parts = [{"text": f"{instruction}\n\nЗАДАЧА: {text}"}]
-        if img_bytes:
-            parts.append({"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(img_bytes).decode()}})
-        
-        payload = {"contents": [{"parts": parts}], "generationConfig": {"temperature": 0.3}}
-        api_url = f"https://generativelanguage.googleapis.com/v1/{self.model_name}:generateContent?key={active_key}"
+    def start(self):
+        # Поток заводим при первой записи: процессам пула картинок он не нужен
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
 
+    def flush(self, timeout=2.0):
+        """Дождаться записи всего, что уже в очереди (перед выходом процесса)"""
+        if self.thread is None: return
+        done = Event()
         try:
-            r = self.session.post(api_url, json=payload, timeout=90)
-            if r.status_code == 429: return "LIMIT_ERROR"
-            return r.json()['candidates'][0]['content']['parts'][0]['text']
-        except:
-            return "ERROR"
-
-    def send_smart_msg(self, chat_id, text, with_kb=True):
-        limit = 3800
-        parts = [text[i:i + limit] for i in range(0, len(text), limit)]
-        for i, part in enumerate(parts):
-            is_last = (i == len(parts) - 1)
-            payload = {
-                "chat_id": chat_id,
-                "text": part,
-                "parse_mode": "Markdown",
-                "reply_markup": self.get_keyboard() if (is_last and with_kb) else None
-            }
-            try:
-                self.session.post(self.tg_url + "sendMessage", json=payload)
-            except:
-                payload.pop("parse_mode", None)
-                self.session.post(self.tg_url + "sendMessage", json=payload)
+            self.queue.put(done, timeout=timeout)
+        except Full:
+            return
+        done.wait(timeout)
 
     def run(self):
-        log("🛰 Бот активен...")
         while True:
+            batch = [self.queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            lines = [self.format(r) for r in batch if not isinstance(r, Event)]
             try:
-                r = self.session.get(self.tg_url + "getUpdates", params={"offset": self.offset, "timeout": 20}).json()
-                for upd in r.get("result", []):
-                    self.offset = upd["update_id"] + 1
-                    
-                    if "callback_query" in upd:
-                        cb = upd["callback_query"]
-                        uid = cb["message"]["chat"]["id"]
-                        self.session.post(self.tg_url + "answerCallbackQuery", json={"callback_query_id": cb["id"]})
-                        
-                        if cb["data"] == "tutorial":
-                            self.send_smart_msg(uid, "🔑 Пришли свой API Key от Google AI Studio.", with_kb=False)
-                        else:
-                            res = self.call_ai("Обнови решение", user_id=uid, sub_mode=cb["data"])
-                            self.send_smart_msg(uid, "🔄 **ОБНОВЛЕНИЕ:**\n\n" + res)
-                        continue
+                if lines:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+            for r in batch:
+                if isinstance(r, Event): r.set()
 
-                    msg = upd.get("message")
-                    if not msg: continue
-                    chat_id = msg["chat"]["id"]
-                    text = msg.get("text", "")
+    def format(self, r):
+        ts = r.pop("ts")
+        if self.fmt == "json":
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1000):03d}Z"
+            return json.dumps({"ts": stamp, **r}, ensure_ascii=False, default=str)
+        # Текст — для глаз: поля уже есть в сообщении, оставляем только trace
+        return f"[{time.strftime('%H:%M:%S', time.localtime(ts))}] {r['msg']}" + (f"  [{r['trace']}]" if "trace" in r else "")
 
-                    if text == "/start":
-                        self.send_smart_msg(chat_id, "👋 Привет! Пришли фото задачи.", with_kb=False)
-                        continue
+class Trace:
+    """След одного апдейта: trace-id в каждой записи от приёма до последнего отправленного сообщения.
+    Апдейт вне выборки LOG_SAMPLE копит записи в памяти и пишет их, только если случились
+    предупреждение/ошибка или он шёл дольше LOG_SLOW, — иначе они выбрасываются"""
+    __slots__ = ("id", "kept", "buffer", "start")
+
+    def __init__(self, update_id):
+        self.id = f"u{update_id}"
+        # Решение по update_id, а не random: все процессы QUEUE_WORKERS сходятся в нём
+        self.kept = (update_id * 2654435761) % 2 ** 32 < LOG_SAMPLE * 2 ** 32
+        self.buffer = []
+        self.start = time.perf_counter()
+
+    def add(self, record):
+        if self.kept:
+            log_writer.put(record)
+        elif record["level"] != "info":
+            self.keep()
+            log_writer.put(record)
+        elif self.buffer is not None:
+            self.buffer.append(record)
+
+    def keep(self):
+        self.kept = True
+        buffer, self.buffer = self.buffer or [], None
+        for record in buffer: log_writer.put(record)
+
+    def end(self):
+        seconds = time.perf_counter() - self.start
+        if not self.kept and seconds >= LOG_SLOW: self.keep()
+        if self.kept: log(f"🧾 [TRACE] Апдейт за {seconds:.2f} с", trace=self, seconds=round(seconds, 3))
+        # Поздние info-записи (отправка из очереди) неотобранного апдейта больше не копим
+        self.buffer = None
+
+trace_var = contextvars.ContextVar("trace", default=None)
+log_writer = LogWriter(LOG_FORMAT, int(os.environ.get("LOG_QUEUE", 10000)))
+atexit.register(log_writer.flush)
+
+class tracing:
+    """with tracing(upd, chat_id): записи log() внутри (и в порождённых задачах/потоках) несут trace апдейта"""
+    def __init__(self, upd, chat_id=None):
+        self.upd = upd
+        self.chat_id = chat_id
+
+    def __enter__(self):
+        self.trace = Trace(self.upd.get("update_id", 0))
+        self.token = trace_var.set(self.trace)
+        kind = next((k for k in self.upd if k != "update_id"), "?")
+        log(f"📥 [UPDATE] {kind} от {self.chat_id}", chat=self.chat_id)
+        return self.trace
+
+    def __exit__(self, *exc):
+        self.trace.end()
+        trace_var.reset(self.token)
+
+def log(message, level=None, trace=None, **fields):
+    """Запись лога: уровень по эмодзи (🛑 — error, ⚠️ — warning), fields — поля JSON-записи"""
+    record = {"ts": time.time(), "level": level or ("error" if message.startswith("🛑") else
+                                                    "warning" if message.startswith("⚠") else "info"),
+              "msg": message}
+    trace = trace or trace_var.get()
+    if fields: record.update(fields)
+    if trace is None:
+        log_writer.put(record)
+        return
+    record["trace"] = trace.id
+    trace.add(record)
+
+# --- ЖИЗНЕННЫЙ ЦИКЛ ---
+class Shutdown(BaseException):
+    """Обрывает ожидание основного цикла по SIGTERM (BaseException — мимо общих except Exception)"""
+
+class Lifecycle:
+    """Готовность и остановка процесса. Render при деплое шлёт SIGTERM и через ~30 с добивает SIGKILL:
+    приём апдейтов закрывается сразу, начатые задачи доделываются не дольше drain_timeout секунд."""
+    def __init__(self, drain_timeout=25.0):
+        self.drain_timeout = drain_timeout
+        self.started = time.monotonic()
+        self.ready = Event()
+        self.stopping = Event()
+        self.children = []           # процессы-воркеры QUEUE_WORKERS: сигнал пересылаем им
+        self.waiting = False         # основной поток в долгом ожидании (long poll) — его можно оборвать
+        self.waiter = None           # то же для async: задача, которую отменяем
+        self.unfinished = 0
+
+    def mark_ready(self, what):
+        if self.stopping.is_set(): return
+        self.ready.set()
+        log(f"✅ [SYS] Готов за {time.monotonic() - self.started:.2f} с ({what})")
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        if self.stopping.is_set(): return
+        self.ready.clear()
+        self.stopping.set()
+        log(f"🛬 [SYS] Сигнал {signal.Signals(signum).name}: приём закрыт, доделываем начатое "
+            f"(до {self.drain_timeout:g} с)")
+        for p in self.children:
+            if p.is_alive(): os.kill(p.pid, signal.SIGTERM)
+        if self.waiter: self.waiter.cancel()
+        if self.waiting: raise Shutdown()
+
+    def install(self):
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.stop)
+
+    def install_async(self):
+        """Обработчики в event loop: они не прерывают код посреди await, а отменяют ожидание"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop, sig)
+
+    def wait(self, fn, *args, **kwargs):
+        """Долгое ожидание основного потока: SIGTERM обрывает его сразу, не дожидаясь таймаута"""
+        self.waiting = True
+        try:
+            if self.stopping.is_set(): raise Shutdown()
+            return fn(*args, **kwargs)
+        finally:
+            self.waiting = False
+
+    async def wait_async(self, aw):
+        self.waiter = asyncio.ensure_future(aw)
+        try:
+            return await self.waiter
+        finally:
+            self.waiter = None
+
+    def exit(self):
+        """Недоделанное за DRAIN_TIMEOUT держит потоки пулов — ждать их при выходе нельзя, Render всё равно убьёт"""
+        log_writer.flush()
+        if self.unfinished:
+            sys.stdout.flush()
+            os._exit(1)
+
+def image_worker_init():
+    """Процесс пула картинок: SIGTERM всей группе его не трогает (фото доделываются при дренаже),
+    а выходит он вместе с родителем"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+    def watch():
+        while os.getppid() == parent: time.sleep(1)
+        os._exit(0)
+    Thread(target=watch, daemon=True).start()
+
+lifecycle = Lifecycle(drain_timeout=float(os.environ.get("DRAIN_TIMEOUT", 25)))
+
+# --- ТЕКСТЫ ---
+TUTORIAL_TEXT = ("🔑 **ИНСТРУКЦИЯ ПО КЛЮЧУ**\n\n"
+                 "1. Зайди на [Google AI Studio](https://aistudio.google.com/app/apikey)\n"
+                 "2. Создай бесплатный API Key.\n"
+                 "3. Просто **пришли его мне** сообщением.\n\n"
+                 "Это снимет любые лимиты!")
+WELCOME_TEXT = ("👋 **Привет! Я твой личный ГДЗ-помощник.**\n\n"
+                "Я использую **Gemini 2.5 Flash**, чтобы решать задачи по фото.\n"
+                "📸 Просто пришли мне фото или напиши условие.")
+KEY_OK_TEXT = "✅ **Ключ привязан!** Теперь я работаю на твоих лимитах."
+LIMIT_TEXT = "⚠️ **Лимиты бота исчерпаны.**\nДобавь свой бесплатный ключ по кнопке ниже!"
+ERROR_TEXT = "❌ Ошибка. Попробуй другое фото."
+NO_TASK_TEXT = "🤔 Не нашёл твою прошлую задачу. Пришли фото или условие ещё раз."
+BUSY_TEXT = "⏳ Слишком много задач подряд. Дождись ответа на предыдущие и пришли эту ещё раз."
+STALE_TEXT = "⌛ Бот был перегружен и не успел ответить вовремя. Пришли задачу ещё раз."
+
+# Добавки к системной инструкции для кнопок режимов
+MODE_SUFFIXES = {
+    "mode_simple": "\nУпрости объяснение до максимума.",
+    "mode_ege": "\nСделай акцент на оформлении для ЕГЭ/ОГЭ.",
+    "mode_en": "\nПереведи решение на английский язык.",
+}
+
+# Режимы, которым сразу нужна основная модель
+STRONG_MODES = ("mode_ege",)
+# Отказы и заглушки: такой ответ дешёвой модели не принимается
+REFUSALS = ("не могу", "не удалось", "не вижу", "неразборчив", "i can't", "i cannot", "unable to")
+# Цена за 1 млн токенов в долларах: (запрос, ответ)
+MODEL_PRICES = {"gemini-2.0-flash": (0.10, 0.40), "gemini-2.0-flash-lite": (0.075, 0.30)}
+
+# Меню под ответом — одно на все сообщения
+MAIN_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "📚 Объясни проще", "callback_data": "mode_simple"},
+         {"text": "📝 Режим ЕГЭ/ОГЭ", "callback_data": "mode_ege"}],
+        [{"text": "🔑 Свой ключ (Инструкция)", "callback_data": "tutorial"},
+         {"text": "🇬🇧 На английский", "callback_data": "mode_en"}]
+    ]
+}
+
+# --- ОБРАБОТКА ФОТО ---
+IMAGE_TARGET = 1600
+
+def pick_photo(sizes, target=IMAGE_TARGET):
+    """Самый маленький PhotoSize, которого ещё хватает на target; иначе самый большой"""
+    enough = [p for p in sizes if max(p.get("width", 0), p.get("height", 0)) >= target]
+    if enough:
+        return min(enough, key=lambda p: p["width"] * p["height"])
+    return sizes[-1]
+
+def image_ready(raw, target=IMAGE_TARGET):
+    """Уже маленький JPEG можно отдать в ИИ как есть (читается только заголовок)"""
+    try:
+        img = Image.open(io.BytesIO(raw))
+        return img.format == "JPEG" and img.mode in ("RGB", "L") and max(img.size) <= target
+    except Exception:
+        return False
+
+def prepare_image(raw, target=IMAGE_TARGET):
+    """Сжатие фото перед отправкой в ИИ"""
+    img = Image.open(io.BytesIO(raw))
+    if img.format == "JPEG" and img.mode in ("RGB", "L") and max(img.size) <= target:
+        return raw
+    # draft(): JPEG уменьшается в 2/4/8 раз прямо при декодировании
+    w, h = img.size
+    if max(w, h) > target:
+        img.draft("RGB", (max(1, w * target // max(w, h)), max(1, h * target // max(w, h))))
+    img = img.convert('RGB')
+    img.thumbnail((target, target))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def image_pages(img):
+    """Снимки задачи: одно фото (bytes) или страницы альбома (tuple)"""
+    if not img: return ()
+    return img if isinstance(img, tuple) else (img,)
+
+def pack_pages(img):
+    """Альбом в один BLOB для SQLite: b"PAGES" + (длина, байты) на страницу; одно фото — как есть"""
+    if not isinstance(img, tuple): return img
+    return b"PAGES" + b"".join(len(p).to_bytes(4, "big") + p for p in img)
+
+def unpack_pages(blob):
+    if not blob or not blob.startswith(b"PAGES"): return blob
+    pages, i = [], 5
+    while i < len(blob):
+        n = int.from_bytes(blob[i:i + 4], "big")
+        pages.append(blob[i + 4:i + 4 + n])
+        i += 4 + n
+    return tuple(pages)
+
+class StageTimer:
+    """Время стадий одного апдейта: getFile, скачивание, сжатие, ИИ, отправка"""
+    def __init__(self):
+        self.stages = []
+        self.t = time.perf_counter()
+
+    def lap(self, name, nbytes=None):
+        now = time.perf_counter()
+        self.stages.append((name, now - self.t, nbytes))
+        metrics.observe("tggb_stage_seconds", now - self.t, stage=name)
+        if nbytes is not None:
+            metrics.observe("tggb_image_bytes", nbytes, buckets=Metrics.BYTES, stage=name)
+        self.t = now
+
+    def fields(self):
+        """Стадии для JSON-записи: {имя: мс}"""
+        return {name: round(sec * 1000) for name, sec, _ in self.stages}
+
+    def summary(self):
+        return " ".join(f"{name}({nbytes // 1024}KB)={sec * 1000:.0f}ms" if nbytes is not None
+                        else f"{name}={sec * 1000:.0f}ms" for name, sec, nbytes in self.stages)
+
+# --- ЗАПРОС К GEMINI: ШАБЛОНЫ, INLINE ИЛИ FILES API ---
+JSON_HEADERS = {"Content-Type": "application/json"}
+UPLOAD_HEADERS = {"X-Goog-Upload-Protocol": "raw", "Content-Type": "image/jpeg"}
+
+class PromptBook:
+    """Промпты режимов, собранные один раз: начало тела запроса до текста задачи уже сериализовано.
+    С контекстным кэшем Gemini общая инструкция хранится у Google, в запросе — только добавка режима."""
+    def __init__(self, system, suffixes, temperature=0.3):
+        self.system = system
+        self.heads = {}              # (режим, через кэш?) -> байты до текста задачи (JSON-строка не закрыта)
+        for mode in ("standard", *suffixes):
+            suffix = suffixes.get(mode, "")
+            self.heads[mode, False] = self._head(system + suffix + "\n\nЗАДАЧА: ")
+            self.heads[mode, True] = self._head((suffix.strip() + "\n\n" if suffix else "") + "ЗАДАЧА: ")
+        self.config = b'"generationConfig":' + json.dumps({"temperature": temperature}).encode() + b"}"
+
+    @staticmethod
+    def _head(text):
+        # Две JSON-строки склеиваются без кавычек между ними: инструкцию не экранируем на каждый запрос
+        return b'{"contents":[{"role":"user","parts":[{"text":' + json.dumps(text, ensure_ascii=False)[:-1].encode()
+
+    def body(self, mode, task, image_part=b"", context=None):
+        head = self.heads.get((mode, context is not None)) or self.heads["standard", context is not None]
+        ctx = b'"cachedContent":' + json.dumps(context).encode() + b"," if context else b""
+        return b"".join((head, json.dumps(task, ensure_ascii=False)[1:].encode(), b"}", image_part, b"]}],",
+                         ctx, self.config))
+
+def inline_image(img):
+    """Часть inline_data: base64 ложится в тело одной склейкой, без копий через str и json.dumps"""
+    return b"".join((b',{"inline_data":{"mime_type":"image/jpeg","data":"', base64.b64encode(img), b'"}}'))
+
+class AiRequest:
+    """Текст + картинка (или страницы альбома). Тело собирается под ключ: URI файлов и кэш контекста
+    привязаны к проекту ключа"""
+    __slots__ = ("book", "mode", "text", "img", "more", "digest", "repeat", "plain", "model", "route", "escalated")
+
+    def __init__(self, book, mode, text, img=None):
+        self.book = book
+        self.mode = mode
+        self.text = text
+        pages = image_pages(img)
+        self.img = pages[0] if pages else None
+        self.more = pages[1:]        # остальные страницы альбома — всегда inline
+        self.digest = hashlib.sha1(self.img).hexdigest() if self.img else None
+        self.repeat = False          # эта картинка уже уходила в Gemini (смена режима)
+        self.plain = False           # ссылка на файл или кэш не сработали — всё прямо в запросе
+        self.model = None            # дешёвая модель от Router; None — основная
+        self.route = "off"
+        self.escalated = False       # ответ дешёвой модели не прошёл Router.accept — нужна именно основная
+
+    def body(self, file_uri=None, context=None):
+        """JSON-байты: по части на каждую страницу"""
+        if file_uri:
+            image = b',{"file_data":{"mime_type":"image/jpeg","file_uri":' + json.dumps(file_uri).encode() + b"}}"
+        elif self.img:
+            image = inline_image(self.img)
+        else:
+            image = b""
+        if self.more: image += b"".join(inline_image(p) for p in self.more)
+        return self.book.body(self.mode, self.text, image, context)
+
+class FileHandles:
+    """Картинки, загруженные в Files API: (ключ, sha1) -> uri. Gemini хранит файл 48 ч"""
+    def __init__(self, min_bytes, ttl=46 * 3600, max_items=2000):
+        self.min_bytes = min_bytes   # None — загрузка выключена, всё inline
+        self.ttl = ttl
+        self.max_items = max_items
+        self.lock = Lock()
+        self.uris = OrderedDict()    # (ключ, sha1) -> (uri, годен до)
+        self.seen = OrderedDict()    # sha1 картинок, которые уже отправлялись
+
+    def note(self, req):
+        if not req.img: return
+        with self.lock:
+            req.repeat = req.digest in self.seen
+            self.seen[req.digest] = True
+            self.seen.move_to_end(req.digest)
+            if len(self.seen) > self.max_items: self.seen.popitem(last=False)
+
+    def wanted(self, req):
+        """Большую или повторную картинку грузим один раз и дальше шлём ссылкой"""
+        if self.min_bytes is None or not req.img or req.more or req.plain: return False
+        return req.repeat or len(req.img) >= self.min_bytes
+
+    def get(self, api_key, digest):
+        with self.lock:
+            item = self.uris.get((api_key, digest))
+            if not item: return None
+            if item[1] < time.time():
+                del self.uris[(api_key, digest)]
+                return None
+            self.uris.move_to_end((api_key, digest))
+            return item[0]
+
+    def put(self, api_key, digest, uri):
+        with self.lock:
+            self.uris[(api_key, digest)] = (uri, time.time() + self.ttl)
+            if len(self.uris) > self.max_items: self.uris.popitem(last=False)
+
+    def forget(self, api_key, digest):
+        with self.lock:
+            self.uris.pop((api_key, digest), None)
+
+# --- КЭШ ОТВЕТОВ ---
+def page_digests(img_bytes):
+    """sha1 каждой подготовленной страницы. Точный хеш, а не перцептивный: у 64-битного dHash
+    разные листы с текстом на белом фоне совпадают, и чужое решение уходило бы по кэшу.
+    Сжатие детерминировано, так что повтор того же фото (тот же file_id, кнопка режима) всё равно попадает"""
+    return tuple(hashlib.sha1(p).hexdigest() for p in image_pages(img_bytes))
+
+class AnswerCache:
+    """Кэш ответов ИИ: LRU в памяти + файлы на диске, с TTL и лимитом размера"""
+    def __init__(self, path=None, ttl=7 * 86400, mem_items=512, disk_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.mem_items = mem_items
+        self.disk_bytes = disk_bytes
+        self.mem = OrderedDict()     # key -> (ts, answer)
+        self.lock = Lock()
+        self.hits = {"mem": 0, "disk": 0}
+        self.misses = 0
+        self.disk_used = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.disk_used = sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+    def key(self, model, text, sub_mode, img_bytes=None):
+        # Лишние пробелы не плодят разные ключи; регистр — значимый (m и M, v и V — разные величины)
+        norm = " ".join((text or "").split())
+        pages = "+".join(page_digests(img_bytes)) or "-"
+        raw = f"{model}\0{norm}\0{MODE_SUFFIXES.get(sub_mode, '')}\0{pages}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            item = self.mem.get(key)
+            if item and now - item[0] < self.ttl:
+                self.mem.move_to_end(key)
+                self.hits["mem"] += 1
+                return item[1]
+            if item: del self.mem[key]
+        item = self._disk_get(key, now)
+        with self.lock:
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits["disk"] += 1
+            self._mem_put(key, item)
+        return item[1]
+
+    def put(self, key, answer):
+        item = (time.time(), answer)
+        with self.lock:
+            self._mem_put(key, item)
+        if self.path:
+            self._disk_put(key, item)
+
+    def _mem_put(self, key, item):
+        self.mem[key] = item
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.mem_items:
+            self.mem.popitem(last=False)
+
+    def _disk_get(self, key, now):
+        if not self.path: return None
+        fpath = os.path.join(self.path, key)
+        try:
+            with open(fpath, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if now - data["ts"] >= self.ttl:
+            self._disk_remove(fpath)
+            return None
+        return data["ts"], data["answer"]
 
-                    if text.strip().startswith("AIza"):
-                        user_keys[chat_id] = text.strip()
-                        self.send_smart_msg(chat_id, "✅ Ключ привязан!", with_kb=False)
+    def _disk_put(self, key, item):
+        fpath = os.path.join(self.path, key)
+        tmp = f"{fpath}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"ts": item[0], "answer": item[1]}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp)
+            # Перезапись того же ключа: старый файл уходит, его размер из счётчика вычитаем
+            try:
+                size -= os.path.getsize(fpath)
+            except OSError:
+                pass
+            os.replace(tmp, fpath)
+        except OSError as e:
+            log(f"🛑 [CACHE] Запись на диск: {e}")
+            return
+        with self.lock:
+            self.disk_used += size
+            over = self.disk_used > self.disk_bytes
+        if over: self._disk_evict()
+
+    def _disk_remove(self, fpath):
+        try:
+            size = os.path.getsize(fpath)
+            os.remove(fpath)
+        except OSError:
+            return
+        with self.lock:
+            self.disk_used -= size
+
+    def _disk_evict(self):
+        """Удаляем протухшие и самые старые файлы, пока не уложимся в 90% лимита"""
+        entries = sorted((e for e in os.scandir(self.path) if e.is_file()), key=lambda e: e.stat().st_mtime)
+        now = time.time()
+        for e in entries:
+            if self.disk_used <= self.disk_bytes * 0.9 and now - e.stat().st_mtime < self.ttl:
+                break
+            self._disk_remove(e.path)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits["mem"] + self.hits["disk"] + self.misses
+            return {"mem_hits": self.hits["mem"], "disk_hits": self.hits["disk"], "misses": self.misses,
+                    "hit_rate": round((total - self.misses) / total, 3) if total else 0.0,
+                    "mem_items": len(self.mem), "disk_bytes": self.disk_used}
+
+# --- СКЛЕЙКА ОДИНАКОВЫХ ЗАПРОСОВ ---
+def flight_key(text, sub_mode, img_bytes=None):
+    """Ключ склейки — точный: текст как есть, режим и sha1 каждой страницы (как AiRequest.digest).
+    Склеенный запрос отдаёт один ответ в несколько чатов, поэтому совпасть должны именно байты"""
+    raw = "\0".join((text or "", sub_mode or "", *page_digests(img_bytes)))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class SingleFlight:
+    """Одинаковые запросы в полёте: к ИИ идёт один, остальные ждут его ответ.
+    owner — чей ключ Gemini (None — общий пул): чужая ошибка могла быть личной (лимит или сбой чужого ключа),
+    и только её повторяют сами — тоже одним запросом на ключ; с тем же ключом ошибку делят, как и ответ"""
+    FAILED = ("ERROR", "LIMIT_ERROR")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}              # key -> [Event, результат, owner] (потоки) или (Future, owner) (asyncio)
+        self.shared = 0              # сколько запросов получили чужой ответ
+
+    def do(self, key, fn, owner=None):
+        """(результат, сами ли делали запрос)"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader: call = self.calls[key] = [Event(), None, owner]
+        if not leader:
+            call[0].wait()
+            if call[1] in self.FAILED and call[2] != owner:
+                return self.do((key, owner), fn, owner)
+            if call[1] not in self.FAILED:
+                with self.lock: self.shared += 1
+            return call[1], False
+        try:
+            call[1] = fn()
+        finally:
+            with self.lock: del self.calls[key]
+            call[0].set()
+        return call[1], True
+
+    async def do_async(self, key, coro_fn, owner=None):
+        call = self.calls.get(key)
+        if call is not None:
+            res = await asyncio.shield(call[0])
+            if res in self.FAILED and call[1] != owner:
+                return await self.do_async((key, owner), coro_fn, owner)
+            if res not in self.FAILED: self.shared += 1
+            return res, False
+        fut = asyncio.get_running_loop().create_future()
+        self.calls[key] = (fut, owner)
+        res = "ERROR"
+        try:
+            res = await coro_fn()
+        finally:
+            del self.calls[key]
+            fut.set_result(res)
+        return res, True
+
+# --- СОСТОЯНИЕ ЧАТОВ ---
+class ChatState:
+    """Последняя задача чата: кнопки режимов решают её заново без повторной загрузки фото"""
+    __slots__ = ("prompt", "img_data", "answer", "ts")
+
+    def __init__(self, prompt, img_data=None, answer=None, ts=None):
+        self.prompt = prompt
+        self.img_data = img_data
+        self.answer = answer
+        self.ts = ts or time.time()
+
+    def size(self):
+        return sum(map(len, image_pages(self.img_data))) + len(self.prompt) + len(self.answer or "")
+
+class ChatStateStore:
+    """LRU по чатам с TTL и лимитом по байтам; SQLite (если задан) переживает рестарт"""
+    def __init__(self, ttl=6 * 3600, max_chats=2000, max_bytes=64 * 1024 * 1024, db_path=None):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()  # chat_id -> ChatState
+        self.used = 0
+        self.lock = Lock()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS chat_state (chat_id INTEGER PRIMARY KEY, "
+                            "prompt TEXT, image BLOB, answer TEXT, ts REAL)")
+            self.db.execute("DELETE FROM chat_state WHERE ts < ?", (time.time() - ttl,))
+            self.db.commit()
+
+    def get(self, chat_id):
+        now = time.time()
+        with self.lock:
+            st = self.states.get(chat_id)
+            if st and now - st.ts < self.ttl:
+                self.states.move_to_end(chat_id)
+                return st
+            if st: self._drop(chat_id)
+            if not self.db: return None
+            row = self.db.execute("SELECT prompt, image, answer, ts FROM chat_state WHERE chat_id = ?",
+                                  (chat_id,)).fetchone()
+            if not row or now - row[3] >= self.ttl: return None
+            st = ChatState(row[0], unpack_pages(row[1]), row[2], row[3])
+            self._put(chat_id, st)
+            return st
+
+    def put(self, chat_id, prompt, img_data=None, answer=None):
+        st = ChatState(prompt, img_data, answer)
+        with self.lock:
+            self._put(chat_id, st)
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO chat_state VALUES (?, ?, ?, ?, ?)",
+                                (chat_id, prompt, pack_pages(img_data), answer, st.ts))
+                self.db.commit()
+        return st
+
+    def _put(self, chat_id, st):
+        if chat_id in self.states: self._drop(chat_id)
+        self.states[chat_id] = st
+        self.used += st.size()
+        # Из памяти вытесняем самые старые чаты; в SQLite они остаются до TTL
+        while self.states and (len(self.states) > self.max_chats or self.used > self.max_bytes):
+            self._drop(next(iter(self.states)))
+
+    def _drop(self, chat_id):
+        self.used -= self.states.pop(chat_id).size()
+
+# --- АЛЬБОМЫ ---
+def merge_album(parts):
+    """Один апдейт из частей альбома: фото по порядку в message["photos"], подпись — первая непустая"""
+    parts = sorted(parts, key=lambda u: u["message"]["message_id"])
+    upd = dict(parts[0])
+    msg = upd["message"] = dict(parts[0]["message"])
+    msg.pop("photo", None)
+    msg["photos"] = [u["message"]["photo"] for u in parts if "photo" in u["message"]]
+    caption = next((u["message"]["caption"] for u in parts if u["message"].get("caption")), None)
+    if caption: msg["caption"] = caption
+    return upd
+
+class AlbumBuffer:
+    """Альбом приходит отдельными апдейтами с общим media_group_id. Части копятся, пока window секунд
+    не приходит новых (но не дольше max_wait), и уходят в работу одним апдейтом — один запрос к ИИ и один ответ.
+    Пока у чата ждёт альбом, его следующие апдейты ждут за ним: порядок чата тот же, что у Telegram.
+    Части живут только в памяти: при падении в эти секунды альбом теряется, как и очередь диспетчера
+    (с QUEUE_DB части сразу пишутся в UpdateLog и склеиваются там)."""
+    def __init__(self, chat_of, window=1.0, max_wait=5.0):
+        self.chat_of = chat_of
+        self.window = window
+        self.max_wait = max_wait
+        self.tick = min(0.1, window / 5) if window > 0 else 1.0
+        self.groups = {}             # (chat_id, media_group_id) -> [апдейты, первая часть, последняя часть]
+        self.chats = {}              # chat_id -> deque: ключи альбомов и придержанные апдейты по порядку прихода
+        self.lock = Lock()
+
+    def hold(self, updates):
+        """Апдейты, которые можно обрабатывать сразу; части альбомов и то, что пришло после них, остаются ждать"""
+        if self.window <= 0: return updates
+        ready = []
+        now = time.monotonic()
+        with self.lock:
+            for upd in updates:
+                msg = upd.get("message") or {}
+                group = msg.get("media_group_id")
+                chat_id = self.chat_of(upd)
+                if not group:
+                    if chat_id in self.chats: self.chats[chat_id].append(upd)
+                    else: ready.append(upd)
+                    continue
+                key = (chat_id, group)
+                g = self.groups.get(key)
+                if g is None:
+                    g = self.groups[key] = [[], now, now]
+                    self.chats.setdefault(chat_id, deque()).append(key)
+                if all(u["update_id"] != upd["update_id"] for u in g[0]): g[0].append(upd)
+                g[2] = now
+        return ready
+
+    def due(self, force=False):
+        """Склеенные альбомы, у которых вышло окно ожидания, и апдейты чата за ними (force — все, при остановке)"""
+        now = time.monotonic()
+        out, albums = [], []
+        with self.lock:
+            for chat_id in list(self.chats):
+                q = self.chats[chat_id]
+                while q:
+                    if isinstance(q[0], dict):
+                        out.append(q.popleft())
                         continue
+                    _, first, last = self.groups[q[0]]
+                    if not (force or now - last >= self.window or now - first >= self.max_wait): break
+                    parts = self.groups.pop(q.popleft())[0]
+                    albums.append(parts)
+                    out.append(parts)
+                if not q: del self.chats[chat_id]
+        for parts in albums:
+            metrics.inc("tggb_albums_total")
+            metrics.inc("tggb_album_parts_total", len(parts))
+        return [merge_album(u) if isinstance(u, list) else u for u in out]
 
-                    img_data = None
-                    if "photo" in msg:
-                        fid = msg["photo"][-1]["file_id"]
-                        f_info = self.session.get(self.tg_url + "getFile", params={"file_id": fid}).json()
-                        raw = self.session.get(f"https://api.telegram.org/file/bot{self.tg_token}/{f_info['result']['file_path']}").content
-                        img = Image.open(io.BytesIO(raw)).convert('RGB')
-                        img.thumbnail((1600, 1600))
-                        buf = io.BytesIO()
-                        img.save(buf, format="JPEG", quality=85)
-                        img_data = buf.getvalue()
-
-                    prmpt = msg.get("text", msg.get("caption", "Реши задачу"))
-                    self.session.post(self.tg_url + "sendChatAction", json={"chat_id": chat_id, "action": "typing"})
-                    ans = self.call_ai(prmpt, img_data, user_id=chat_id)
-
-                    if ans == "LIMIT_ERROR":
-                        self.send_smart_msg(chat_id, "⚠️ Лимиты исчерпаны. Добавь свой ключ!", with_kb=True)
-                    elif ans == "ERROR":
-                        self.send_smart_msg(chat_id, "❌ Ошибка. Попробуй еще раз.", with_kb=False)
+    def pending(self):
+        with self.lock:
+            return sum(len(g[0]) for g in self.groups.values()) + \
+                sum(isinstance(x, dict) for q in self.chats.values() for x in q)
+
+# --- ОБЩАЯ ОЧЕРЕДЬ АПДЕЙТОВ (НЕСКОЛЬКО ПРОЦЕССОВ) ---
+class UpdateLog:
+    """Долговечная очередь в SQLite (WAL): приёмщик пишет апдейты вместе с offset, воркеры разбирают.
+    Чату выдаётся только самый ранний апдейт и только если он ни у кого не в работе;
+    упал воркер — аренда истекает и апдейт получает другой (at-least-once).
+    Части альбомов пишутся сразу, как пришли, и склеиваются при выдаче, когда окно альбома закрылось."""
+    def __init__(self, path, lease=300, max_attempts=5, album_window=1.0, album_max_wait=5.0):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.album_window = album_window
+        self.album_max_wait = album_max_wait
+        self.lock = Lock()
+        # isolation_level=None — транзакции открываем сами (BEGIN IMMEDIATE), timeout — ожидание других процессов
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # В WAL режим NORMAL переживает падение процесса (не питания) и не делает fsync на каждый коммит
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, chat_id INTEGER, "
+                        "body TEXT NOT NULL, owner TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0)")
+        # Очередь от прежней версии — без колонок альбома
+        cols = {row[1] for row in self.db.execute("PRAGMA table_info(updates)")}
+        for col, kind in (("album", "TEXT"), ("arrived", "REAL")):
+            if col not in cols: self.db.execute(f"ALTER TABLE updates ADD COLUMN {col} {kind}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS updates_chat ON updates (chat_id, update_id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER)")
+
+    def offset(self):
+        """Offset для getUpdates: всё до него уже лежит в очереди"""
+        with self.lock:
+            row = self.db.execute("SELECT v FROM meta WHERE k = 'offset'").fetchone()
+        return row[0] if row else 0
+
+    def append(self, updates, chat_of):
+        now = time.time()
+        rows = [(u["update_id"], chat_of(u), json.dumps(u, ensure_ascii=False),
+                 (u.get("message") or {}).get("media_group_id"), now) for u in updates]
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT OR IGNORE INTO updates (update_id, chat_id, body, album, arrived) "
+                                    "VALUES (?, ?, ?, ?, ?)", rows)
+                # Offset в той же транзакции: после рестарта не теряем и не берём апдейты повторно
+                self.db.execute("INSERT INTO meta VALUES ('offset', ?) ON CONFLICT(k) DO UPDATE SET v = max(v, excluded.v)",
+                                (max(r[0] for r in rows) + 1,))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def claim(self, owner, limit):
+        """До limit апдейтов — головы свободных чатов; аренда на self.lease секунд.
+        Голова — часть альбома: чат ждёт, пока окно альбома не закроется, потом все части уходят одним апдейтом."""
+        now = time.time()
+        jobs, albums = [], []
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    "SELECT update_id, chat_id, body, attempts, album FROM updates u WHERE (owner IS NULL OR lease_until < ?) "
+                    "AND (chat_id IS NULL OR update_id = (SELECT MIN(update_id) FROM updates WHERE chat_id = u.chat_id)) "
+                    "ORDER BY update_id LIMIT ?", (now, limit)).fetchall()
+                for update_id, chat_id, body, attempts, album in rows:
+                    parts = [(update_id, body)]
+                    if album and self.album_window > 0:
+                        group = self.db.execute(
+                            "SELECT update_id, body, arrived FROM updates WHERE chat_id = ? AND album = ? "
+                            "AND (owner IS NULL OR lease_until < ?) ORDER BY update_id", (chat_id, album, now)).fetchall()
+                        arrived = [a or 0 for _, _, a in group]
+                        if now - max(arrived) < self.album_window and now - min(arrived) < self.album_max_wait: continue
+                        parts = [(i, b) for i, b, _ in group]
+                    ids = [i for i, _ in parts]
+                    marks = ",".join("?" * len(ids))
+                    if attempts >= self.max_attempts:
+                        # Апдейт, который раз за разом роняет воркер, не должен навсегда блокировать чат
+                        log(f"🗑 [QUEUE] Апдейт {update_id} брошен после {attempts} попыток")
+                        self.db.execute(f"DELETE FROM updates WHERE update_id IN ({marks})", ids)
+                        continue
+                    self.db.execute(f"UPDATE updates SET owner = ?, lease_until = ?, attempts = attempts + 1 "
+                                    f"WHERE update_id IN ({marks})", [owner, now + self.lease] + ids)
+                    if album and self.album_window > 0:
+                        albums.append(len(parts))
+                        jobs.append(merge_album([json.loads(b) for _, b in parts]))
                     else:
-                        self.send_smart_msg(chat_id, ans)
+                        jobs.append(json.loads(body))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        for n in albums:
+            metrics.inc("tggb_albums_total")
+            metrics.inc("tggb_album_parts_total", n)
+        return jobs
 
-            except Exception as e:
-                log(f"🛑 Ошибка: {e}")
-                time.sleep(5)
+    def _parts(self, update_id):
+        """Условие на апдейт, а для склеенного альбома — на все его части той же аренды"""
+        row = self.db.execute("SELECT chat_id, album, owner FROM updates WHERE update_id = ?", (update_id,)).fetchone()
+        if not row or row[1] is None: return "update_id = ?", (update_id,)
+        return "chat_id = ? AND album = ? AND owner IS ?", row
 
-# --- ЗАПУСК ---
-if __name__ == "__main__":
-    # Сначала запускаем веб-сервер, чтобы Render увидел активный порт
-    Thread(target=run_web, daemon=True).start()
-    # Затем запускаем основного бота
-    UltraGdzBot().run()
-        self.tg_url = f"https://api.telegram.org/bot{self.tg_token}/"
-        self.model_name = "models/gemini-2.0-flash" 
+    def ack(self, update_id):
+        with self.lock:
+            where, args = self._parts(update_id)
+            self.db.execute(f"DELETE FROM updates WHERE {where}", args)
+
+    def release(self, update_id):
+        """Обработка упала — апдейт сразу доступен любому воркеру"""
+        with self.lock:
+            where, args = self._parts(update_id)
+            self.db.execute(f"UPDATE updates SET owner = NULL, lease_until = NULL WHERE {where}", args)
+
+    def release_owner(self, owner):
+        """Воркер остановился: его недоделанные апдейты свободны сразу, попытка не засчитывается"""
+        with self.lock:
+            return self.db.execute("UPDATE updates SET owner = NULL, lease_until = NULL, attempts = max(attempts - 1, 0) "
+                                   "WHERE owner = ?", (owner,)).rowcount
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+
+# --- РАЗМЕТКА И ДЕЛЕНИЕ ОТВЕТОВ ---
+MD_SPECIAL = re.compile(r"[\\*_`\[]")
+MD_ENTITY = re.compile(r"[*_`\[]")
+MD_LINK = re.compile(r"\[[^\]\n]+\]\([^)\s]+\)")
+SPLIT_AT = ("\n\n", "\n", ". ", " ")
+
+def md_scan(text):
+    """Разметка, которую примет Telegram (Markdown v1): **жирный** -> *жирный*, непарные *, _, `, [
+    экранируются; * и _ внутри слов (a_1, 2*3) — тоже. Возвращает (текст, [(начало, конец) сущностей])."""
+    out, spans = [], []
+    pos, i, n = 0, 0, len(text)      # pos — длина уже собранного текста
+    def emit(piece, entity=False):
+        nonlocal pos
+        if entity: spans.append((pos, pos + len(piece)))
+        out.append(piece)
+        pos += len(piece)
+    while i < n:
+        m = MD_SPECIAL.search(text, i)
+        if not m:
+            emit(text[i:])
+            break
+        j = m.start()
+        if j > i: emit(text[i:j])
+        c = text[j]
+        i = j + 1
+        if c == "\\":
+            # Уже экранированный символ оставляем как есть
+            if i < n and text[i] in "*_`[":
+                emit(text[j:i + 1])
+                i += 1
+            else:
+                emit(c)
+            continue
+        if c == "`":
+            fence = "```" if text.startswith("```", j) else "`"
+            end = text.find(fence, j + len(fence))
+            if end != -1:
+                i = end + len(fence)
+                emit(text[j:i], entity=True)
+            else:
+                emit("\\`")
+            continue
+        if c == "[":
+            link = MD_LINK.match(text, j)
+            if link:
+                i = link.end()
+                emit(link.group(), entity=True)
+            else:
+                emit("\\[")
+            continue
+        # * или _ ; Gemini пишет жирный как **...**
+        width = 2 if c == "*" and text.startswith("**", j) else 1
+        closer = text.find(c * width, j + width)
+        para = text.find("\n\n", j)
+        ok = (closer > j + width and (para == -1 or closer < para)
+              and (j == 0 or not text[j - 1].isalnum()) and not text[j + width].isspace()
+              and not text[closer - 1].isspace()
+              and (closer + width >= n or not text[closer + width].isalnum()))
+        if ok and c not in text[j + width:closer]:
+            emit(c + text[j + width:closer] + c, entity=True)
+            i = closer + width
+        else:
+            emit("\\" + c)
+            if width == 2: emit("\\" + c)
+            i = j + width
+    return "".join(out), spans
+
+def md_fix(text):
+    return md_scan(text)[0]
+
+def md_plain(text):
+    """Экранирование обратно — для отправки без parse_mode"""
+    return re.sub(r"\\([*_`\[])", r"\1", text)
+
+def split_cut(text, start, end, skip=()):
+    """Последний разрез в (start, end) по абзацу, строке, предложению, пробелу — не внутри сущностей skip; -1 — нет"""
+    for sep in SPLIT_AT:
+        e = end
+        while True:
+            k = text.rfind(sep, start + 1, e)
+            if k == -1: break
+            if not any(a < k + len(sep) <= b - 1 for a, b in skip): return k + len(sep)
+            e = k
+    return -1
+
+def split_text(text, limit, spans=()):
+    """Куски до limit символов: режем по абзацу, строке, предложению, пробелу — и не внутри сущностей"""
+    chunks, start = [], 0
+    while len(text) - start > limit:
+        end = start + limit
+        cut = split_cut(text, start, end, spans)
+        block = next(((a, b) for a, b in spans if a < end <= b - 1 and text.startswith("```", a)), None)
+        if block and block[1] - block[0] > limit and (cut == -1 or cut - start < limit // 2):
+            # Блок кода всё равно не влезет в одно сообщение: короткий кусок перед ним был бы лишним
+            # запросом — режем внутри блока, сразу заполняя это сообщение
+            inner = split_cut(text, max(start, block[0] + 3), end - 4)   # 4 — на закрывающий \n```
+            if inner != -1: cut = inner
+        if cut == -1: cut = split_cut(text, start, end)
+        if cut == -1: cut = end                  # сплошной текст без пробелов — режем как есть
+        inside = next(((a, b) for a, b in spans if a < cut <= b - 1), None)
+        if inside and text.startswith("```", inside[0]):
+            # Блок кода длиннее сообщения: закрываем его в этом куске и открываем в следующем
+            chunks.append(text[start:cut].rstrip() + "\n```")
+            text = text[:cut] + "```\n" + text[cut:]
+            spans = [(cut, b + 4) if (a, b) == inside else (a + 4, b + 4) if a >= cut else (a, b)
+                     for a, b in spans]
+        else:
+            chunks.append(text[start:cut].rstrip())
+        start = cut
+    chunks.append(text[start:])
+    return [c for c in chunks if c.strip()]
+
+def render_chunks(text, limit=3800):
+    """[(кусок, parse_mode)] — разметка проверена заранее, чтобы каждый кусок ушёл с первой попытки"""
+    fixed, spans = md_scan(text)
+    out = []
+    for chunk in split_text(fixed, limit, spans):
+        # Разрез пришёлся внутрь сущности (огромный блок кода) — чиним кусок отдельно
+        chunk = md_fix(md_plain(chunk)) if md_fix(chunk) != chunk else chunk
+        out.append((chunk, "Markdown" if MD_ENTITY.search(chunk) else None))
+    return out
+
+# --- СТРИМИНГ ОТВЕТОВ ---
+def parse_sse_chunk(line):
+    """(текст, usageMetadata) из строки SSE от streamGenerateContent (data: {...})"""
+    if not line or not line.startswith("data:"): return "", None
+    try:
+        event = json.loads(line[5:])
+        cand = event["candidates"][0]
+        return "".join(p.get("text", "") for p in cand.get("content", {}).get("parts", [])), event.get("usageMetadata")
+    except (ValueError, KeyError, IndexError):
+        return "", None
+
+class StreamReply:
+    """Сообщения, в которых печатается ответ: решает, что отправить, а что отредактировать"""
+    def __init__(self, chat_id, limit=3800, interval=1.5):
+        self.chat_id = chat_id
+        self.limit = limit
+        self.interval = interval
+        self.sent = []               # [message_id, показанный текст] по кускам
+        self.last = 0.0
+
+    def ops(self, text, final=False, keyboard=None):
+        """Список (метод, номер куска, тело) для Bot API; правки не чаще interval"""
+        now = time.monotonic()
+        if not final and self.sent and now - self.last < self.interval: return []
+        self.last = now
+        # Недописанный Markdown Telegram не примет, поэтому разметка — только в финале
+        if final:
+            segs = render_chunks(text, self.limit)
+        else:
+            segs = [(seg, None) for seg in split_text(text, self.limit)]
+        segs = segs or [("✍️ Решаю...", None)]
+        out = []
+        for i, (seg, parse_mode) in enumerate(segs):
+            is_last = (i == len(segs) - 1)
+            body = {"chat_id": self.chat_id, "text": seg if (final or not is_last or not text) else seg + " ▌"}
+            if parse_mode: body["parse_mode"] = parse_mode
+            if final and is_last and keyboard: body["reply_markup"] = keyboard
+            if i < len(self.sent):
+                if not final and self.sent[i][1] == body["text"]: continue
+                body["message_id"] = self.sent[i][0]
+                out.append(("editMessageText", i, body))
+            else:
+                out.append(("sendMessage", i, body))
+        if final:
+            # Финальная разбивка может выйти короче промежуточной — лишние сообщения убираем
+            out += [("deleteMessage", i, {"chat_id": self.chat_id, "message_id": self.sent[i][0]})
+                    for i in range(len(segs), len(self.sent))]
+        return out
+
+    def abort_ops(self):
+        """Ошибка до первого текста — убираем заглушку «Решаю...»"""
+        if len(self.sent) == 1 and self.sent[0][1] == "✍️ Решаю...":
+            return [("deleteMessage", 0, {"chat_id": self.chat_id, "message_id": self.sent[0][0]})]
+        return []
+
+    def done(self, i, body, result):
+        if i < len(self.sent):
+            self.sent[i][1] = body.get("text", "")
+        elif isinstance(result, dict):
+            self.sent.append([result["message_id"], body["text"]])
+
+# --- ПУЛ КЛЮЧЕЙ GEMINI ---
+class KeyState:
+    """Токен-бакет одного ключа: rpm запросов в минуту, адаптивно снижается после 429"""
+    __slots__ = ("key", "max_rpm", "rpm", "tokens", "updated", "cooldown_until", "strikes", "recent")
+
+    def __init__(self, key, rpm):
+        self.key = key
+        self.max_rpm = rpm
+        self.rpm = rpm
+        self.tokens = float(rpm)
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self.strikes = 0             # 429 подряд — для экспоненциальной паузы
+        self.recent = deque()        # время запросов за последнюю минуту
+
+    def refill(self, now):
+        self.tokens = min(self.rpm, self.tokens + (now - self.updated) * self.rpm / 60)
+        self.updated = now
+        while self.recent and now - self.recent[0] > 60:
+            self.recent.popleft()
+
+class KeyPool:
+    """Несколько админских ключей: запрос уходит на ключ с наибольшим запасом"""
+    def __init__(self, keys, rpm=15, max_wait=10.0):
+        self.keys = [KeyState(k, rpm) for k in keys]
+        self.by_key = {k.key: k for k in self.keys}
+        self.max_wait = max_wait
+        self.lock = Lock()
+
+    def acquire(self, exclude=()):
+        """(ключ, сколько подождать до свободного токена) или (None, 0), если всё исчерпано"""
+        now = time.monotonic()
+        with self.lock:
+            best = None
+            for k in self.keys:
+                if k.key in exclude or k.cooldown_until > now: continue
+                k.refill(now)
+                if best is None or k.tokens > best.tokens: best = k
+            if best is None: return None, 0
+            wait = 0.0 if best.tokens >= 1 else (1 - best.tokens) * 60 / best.rpm
+            if wait > self.max_wait: return None, 0
+            # Токен резервируем сразу (уходим «в долг»), чтобы параллельные запросы не взяли тот же
+            best.tokens -= 1
+            best.recent.append(now + wait)
+            return best.key, wait
+
+    def report(self, key, status, retry_after=None):
+        k = self.by_key.get(key)
+        if not k: return                 # личный ключ пользователя — не наш
+        with self.lock:
+            if status == 429:
+                k.strikes += 1
+                k.rpm = max(1.0, k.rpm * 0.7)
+                k.tokens = min(k.tokens, 0.0)
+                pause = retry_after or min(300, 15 * 2 ** (k.strikes - 1))
+                k.cooldown_until = time.monotonic() + pause
+                log(f"⏳ [KEYS] Ключ …{key[-4:]} на паузе {pause:.0f}с, лимит {k.rpm:.1f}/мин")
+            elif status == 200:
+                k.strikes = 0
+                k.rpm = min(k.max_rpm, k.rpm + 0.5)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            for k in self.keys: k.refill(now)
+            return [{"key": f"…{k.key[-4:]}", "rpm_limit": round(k.rpm, 1), "tokens": round(k.tokens, 1),
+                     "last_minute": len(k.recent), "cooldown": max(0, round(k.cooldown_until - now))}
+                    for k in self.keys]
+
+def retry_after_of(r):
+    """Пауза из ответа 429: заголовок Retry-After или retryDelay в теле Gemini"""
+    try:
+        if r.headers.get("Retry-After"): return float(r.headers["Retry-After"])
+        for d in r.json().get("error", {}).get("details", []):
+            if "retryDelay" in d: return float(d["retryDelay"].rstrip("s"))
+    except Exception:
+        pass
+    return None
+
+# --- ВЫБОР МОДЕЛИ ---
+def image_bpp(img_bytes):
+    """Байт JPEG на пиксель — грубая мера сложности снимка: густой почерк и формулы жмутся хуже"""
+    try:
+        w, h = Image.open(io.BytesIO(img_bytes)).size
+    except Exception:
+        return 1.0
+    return len(img_bytes) / max(1, w * h)
+
+def record_usage(model, usage):
+    """Токены и примерная стоимость запроса по моделям (usageMetadata из ответа Gemini)"""
+    if not usage: return
+    name = model.rsplit("/", 1)[-1]
+    prompt, output = usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0)
+    metrics.inc("tggb_gemini_tokens_total", prompt, model=name, kind="prompt")
+    metrics.inc("tggb_gemini_tokens_total", output, model=name, kind="output")
+    price_in, price_out = MODEL_PRICES.get(name, (0, 0))
+    metrics.inc("tggb_gemini_cost_usd_total", (prompt * price_in + output * price_out) / 1e6, model=name)
+
+class Router:
+    """Простые задачи — дешёвой модели, сложные и не прошедшие проверку — основной.
+    Решения, длины текстов и плотность снимков идут в /metrics, чтобы подбирать пороги."""
+    CHARS = (50, 100, 200, 400, 800, 1600, 3200)
+    BPP = (0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.6, 1.0)
+
+    def __init__(self, cheap_model, max_chars=400, max_bpp=0.2, strong_modes=STRONG_MODES):
+        self.cheap_model = cheap_model
+        self.max_chars = max_chars
+        self.max_bpp = max_bpp
+        self.strong_modes = strong_modes
+
+    def route(self, req):
+        """(модель или None — основная, причина)"""
+        if not self.cheap_model: return None, "off"
+        if req.mode in self.strong_modes:
+            reason = "mode"
+        elif req.more:
+            reason = "album"
+        elif req.img:
+            bpp = image_bpp(req.img)
+            metrics.observe("tggb_route_image_bpp", bpp, buckets=self.BPP)
+            reason = "dense_image" if bpp > self.max_bpp else "simple_image"
+        else:
+            metrics.observe("tggb_route_text_chars", len(req.text), buckets=self.CHARS)
+            reason = "long_text" if len(req.text) > self.max_chars else "short_text"
+        model = self.cheap_model if reason in ("simple_image", "short_text") else None
+        metrics.inc("tggb_route_total", tier="cheap" if model else "main", reason=reason)
+        return model, reason
+
+    def accept(self, ans):
+        """Проверка ответа дешёвой модели: не ошибка, не обрывок, есть итог, нет отказа"""
+        if ans in ("ERROR", "LIMIT_ERROR") or len(ans) < 40: return False
+        low = ans.lower()
+        if "ответ" not in low and "answer" not in low: return False
+        return not any(r in low for r in REFUSALS)
+
+# --- ЗАЩИТА ОТ СБОЕВ GEMINI ---
+TRANSIENT = (500, 502, 503, 504)
+
+class CircuitBreaker:
+    """После fails сбоев подряд цепь размыкается на cooldown секунд: запросы туда не идут.
+    Потом снова пропускает, и первый же сбой размыкает её ещё раз, а первый успех замыкает."""
+    def __init__(self, fails=5, cooldown=30.0):
+        self.fails_to_open = fails
+        self.cooldown = cooldown
+        self.fails = 0
+        self.open_until = 0.0
+        self.lock = Lock()
+
+    def allow(self):
+        return self.fails < self.fails_to_open or time.monotonic() >= self.open_until
+
+    def record(self, ok):
+        """True — цепь только что разомкнулась"""
+        with self.lock:
+            if ok:
+                self.fails = 0
+                return False
+            self.fails += 1
+            if self.fails < self.fails_to_open: return False
+            was_open = time.monotonic() < self.open_until
+            self.open_until = time.monotonic() + self.cooldown
+            return not was_open
+
+class Breakers:
+    """Предохранители по ключам и моделям"""
+    def __init__(self, fails=5, cooldown=30.0):
+        self.fails = fails
+        self.cooldown = cooldown
+        self.items = {}              # (вид, имя) -> CircuitBreaker
+        self.lock = Lock()
+
+    def get(self, kind, name):
+        b = self.items.get((kind, name))
+        if b is None:
+            with self.lock:
+                b = self.items.setdefault((kind, name), CircuitBreaker(self.fails, self.cooldown))
+        return b
+
+    def allow(self, kind, name):
+        return self.get(kind, name).allow()
+
+    def record(self, kind, name, ok):
+        if self.get(kind, name).record(ok):
+            label = f"…{name[-4:]}" if kind == "key" else name
+            metrics.inc("tggb_breaker_trips_total", kind=kind)
+            log(f"🔌 [BREAKER] {kind} {label}: {self.fails} сбоев подряд, пауза {self.cooldown:.0f}с")
+
+    def stats(self):
+        with self.lock:
+            items = list(self.items.items())
+        return [(kind, f"…{name[-4:]}" if kind == "key" else name, 0 if b.allow() else 1)
+                for (kind, name), b in items]
+
+class LatencyWindow:
+    """Последние времена ответа модели — для бюджета хеджирования (p95)"""
+    def __init__(self, size=200, min_samples=20):
+        self.values = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def p95(self):
+        values = sorted(self.values)
+        if len(values) < self.min_samples: return None
+        return values[int(len(values) * 0.95)]
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    """Пауза перед повтором: случайная от 0 до base·2^attempt (full jitter)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def transient_error(e):
+    """Сетевая ошибка, которую стоит повторить: не дошли или соединение оборвалось, но не долгий таймаут ответа"""
+    # Библиотеку узнаём по модулю исключения, чтобы не подгружать клиент другого движка
+    lib = type(e).__module__.split(".", 1)[0]
+    if lib == "requests":
+        return isinstance(e, requests.ConnectionError) and not isinstance(e, requests.ReadTimeout)
+    if lib == "httpx":
+        return isinstance(e, httpx.TransportError) and not isinstance(e, httpx.ReadTimeout)
+    return False
+
+# --- СЕТЕВОЙ ТРАНСПОРТ ---
+LONG_POLL = 20                   # секунд ждёт getUpdates
+# HTTP/2 к Gemini и Bot API, если установлен h2 (httpx[http2]); HTTP2=0 — только HTTP/1.1
+HTTP2 = os.environ.get("HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+def pool_specs(bot, files, ai, connect=5.0):
+    """Пулы по назначению: (соединений, (connect, read) таймаут). poll — только long poll getUpdates
+    (read с запасом на LONG_POLL), bot — остальные вызовы Bot API, files — скачивание фото,
+    ai — Gemini (генерация до 90 с, загрузка файлов, кэш контекста)"""
+    return {"poll": (2, (connect, LONG_POLL + 10)),
+            "bot": (bot, (connect, 30)),
+            "files": (files, (connect, 60)),
+            "ai": (ai, (connect, 90))}
+
+class HttpPools:
+    """Своя сессия requests на каждое назначение: long poll не держит сокет отправки, скачивание фото
+    не стоит за 90-секундными ответами Gemini, зависший сокет отваливается по своему таймауту.
+    requests умеет только HTTP/1.1 — соединений в пуле столько, сколько запросов идёт параллельно"""
+    def __init__(self, pools):
+        self.sessions = {}
+        self.timeouts = {}
+        for name, (size, timeout) in pools.items():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.sessions[name] = session
+            self.timeouts[name] = timeout
+
+    def get(self, pool, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts[pool])
+        return self.sessions[pool].get(url, **kwargs)
+
+    def post(self, pool, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts[pool])
+        return self.sessions[pool].post(url, **kwargs)
+
+class AsyncHttpPools:
+    """То же на httpx. Пулы из http2 работают по HTTP/2, если сервер его поддерживает: запросы идут
+    потоками одного TLS-соединения — без очереди за долгим ответом и без новых рукопожатий"""
+    def __init__(self, pools, http2=(), keepalive=60.0):
+        self.clients = {}
+        for name, (size, (connect, read)) in pools.items():
+            # keepalive_expiry по умолчанию 5 с — простаивающее соединение закрывалось бы между апдейтами
+            limits = httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=keepalive)
+            self.clients[name] = httpx.AsyncClient(http2=name in http2, limits=limits,
+                                                   timeout=httpx.Timeout(read, connect=connect))
+
+    def get(self, pool, url, **kwargs):
+        return self.clients[pool].get(url, **kwargs)
+
+    def post(self, pool, url, **kwargs):
+        return self.clients[pool].post(url, **kwargs)
+
+    def stream(self, pool, method, url, **kwargs):
+        return self.clients[pool].stream(method, url, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.gather(*(c.aclose() for c in self.clients.values()))
+
+# --- КЛАСС БОТА (БЕЗ ОШИБОК ОТСТУПОВ) ---
+class UltraGdzBot:
+    def __init__(self):
+        log("⚙️ Сборка системы...")
+        if not os.getenv("KEYSTORE_SECRET"):
+            log("⚠️ KEYSTORE_SECRET не задан — личные ключи шифруются производным от TELEGRAM_TOKEN")
+        self.tg_token = os.getenv("TELEGRAM_TOKEN")
+        self.admin_key = os.getenv("GEMINI_API_KEY")
+        # GEMINI_API_KEYS="key1,key2,..." — пул админских ключей (по умолчанию один GEMINI_API_KEY)
+        admin_keys = [k.strip() for k in os.getenv("GEMINI_API_KEYS", self.admin_key or "").split(",") if k.strip()]
+        self.key_pool = KeyPool(admin_keys, rpm=float(os.environ.get("KEY_RPM", 15)))
+        self.tg_url = f"{TELEGRAM_API}/bot{self.tg_token}/"
+        self.model_name = "models/gemini-2.0-flash"
         self.offset = 0
-        self.session = requests.Session()
-        
+        self.workers = int(os.environ.get("WORKERS", 8))
+        # STREAM_ANSWERS=1 — ответ печатается по мере генерации
+        self.streaming = os.environ.get("STREAM_ANSWERS") == "1"
+        self.stream_interval = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))
+        # Кэш ответов: CACHE_DIR="" отключает дисковый уровень
+        self.cache = AnswerCache(path=os.environ.get("CACHE_DIR", ".cache/answers") or None,
+                                 ttl=int(os.environ.get("CACHE_TTL", 7 * 86400)),
+                                 mem_items=int(os.environ.get("CACHE_MEM_ITEMS", 512)),
+                                 disk_bytes=int(os.environ.get("CACHE_DISK_MB", 200)) * 1024 * 1024)
+        # Последняя задача каждого чата для кнопок режимов
+        self.states = ChatStateStore(ttl=int(os.environ.get("STATE_TTL", 6 * 3600)),
+                                     db_path=os.environ.get("STATE_DB"))
+        self.flights = SingleFlight()
+        upload_kb = os.environ.get("FILE_UPLOAD_KB", "512")
+        self.file_handles = FileHandles(int(upload_kb) * 1024 if upload_kb else None)
+        # QUEUE_DB — общая очередь апдейтов для нескольких процессов (см. UpdateLog)
+        queue_db = os.environ.get("QUEUE_DB")
+        # Альбом (несколько фото сразу) решается одним запросом: ALBUM_WINDOW — сколько ждать следующую часть
+        album_window = float(os.environ.get("ALBUM_WINDOW", 1.0))
+        album_max_wait = float(os.environ.get("ALBUM_MAX_WAIT", 5.0))
+        self.update_log = UpdateLog(queue_db, lease=int(os.environ.get("QUEUE_LEASE", 300)), album_window=album_window,
+                                    album_max_wait=album_max_wait) if queue_db else None
+        self.queue_owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.queue_poll = float(os.environ.get("QUEUE_POLL", 0.2))
+        # С QUEUE_DB части сразу пишутся в очередь (offset не уходит дальше сохранённого), склеивает их UpdateLog
+        self.albums = AlbumBuffer(self.chat_of, window=0 if queue_db else album_window, max_wait=album_max_wait)
+        self.image_cost = float(os.environ.get("IMAGE_COST", 4))
+        # CONTEXT_CACHE_TTL — кэш контекста Gemini для общей инструкции (сек, 0 — выключен).
+        # Gemini кэширует только длинные промпты (от ~1–4 тыс. токенов, зависит от модели),
+        # короткая инструкция получит отказ — тогда ключ помечается до конца TTL и запросы идут как обычно.
+        self.context_ttl = int(os.environ.get("CONTEXT_CACHE_TTL", 0))
+        self.contexts = FileHandles(None, ttl=max(self.context_ttl - 60, 60) if self.context_ttl else 3600)
+        # Сбои Gemini: после BREAKER_FAILS ошибок подряд ключ/модель выключаются на BREAKER_COOLDOWN секунд,
+        # 5xx и обрывы соединения повторяются до GEMINI_RETRIES раз, а ответ дольше p95 (не меньше HEDGE_MIN)
+        # дублируется в GEMINI_FALLBACK_MODEL ("" — без запасной модели)
+        self.fallback_model = os.environ.get("GEMINI_FALLBACK_MODEL", "models/gemini-2.0-flash-lite") or None
+        self.breakers = Breakers(fails=int(os.environ.get("BREAKER_FAILS", 5)),
+                                 cooldown=float(os.environ.get("BREAKER_COOLDOWN", 30)))
+        self.ai_retries = int(os.environ.get("GEMINI_RETRIES", 2))
+        self.hedge_min = float(os.environ.get("HEDGE_MIN", 3))
+        self.latency = {}            # модель -> LatencyWindow
+        # Простые задачи (короткий текст, несложный снимок) сначала решает CHEAP_MODEL ("" — всё основной),
+        # ответ без итога или с отказом уходит основной модели
+        self.router = Router(os.environ.get("CHEAP_MODEL", "models/gemini-2.0-flash-lite") or None,
+                             max_chars=int(os.environ.get("ROUTE_MAX_CHARS", 400)),
+                             max_bpp=float(os.environ.get("ROUTE_MAX_BPP", 0.2)))
+        # Pillow — в отдельных процессах, чтобы не делить GIL с сетью (IMAGE_PROCS=0 — в потоке воркера)
+        procs = int(os.environ.get("IMAGE_PROCS", min(4, os.cpu_count() or 1)))
+        self.image_pool = None
+        if procs > 0:
+            self.image_pool = ProcessPoolExecutor(max_workers=procs, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=image_worker_init)
+        # Прогрев: процессы стартуют сейчас, а не на первом фото (ждёт их warm)
+        self.image_warm = self.image_pool.submit(pow, 1, 1) if self.image_pool else None
+
         # Системные инструкции (10 идей развития)
         self.system_instructions = (
             "Ты — элитный ИИ-репетитор. Твои правила:\n"
@@ -175,441 +1629,1600 @@ if __name__ == "__main__":
             "5. Используй LaTeX и Markdown для четкости.\n"
             "6. Объясняй шаги так, чтобы понял даже слабый ученик."
         )
+        self.prompts = PromptBook(self.system_instructions, MODE_SUFFIXES)
+        models = {m for m in (self.model_name, self.fallback_model, self.router.cheap_model) if m}
+        self.ai_urls = {(model, stream, ctx): f"{GEMINI_API}/{'v1beta' if ctx else 'v1'}/{model}:"
+                        + ("streamGenerateContent?alt=sse&key=" if stream else "generateContent?key=")
+                        for model in models for stream in (False, True) for ctx in (False, True)}
+        self.setup_io()
+        metrics.collect(self.collect_metrics)
+
+    def collect_metrics(self):
+        """Глубины очередей, кэш и ключи — считаются в момент запроса /metrics"""
+        out = [("tggb_webhook_queue", {}, update_queue.qsize())]
+        if self.dispatcher:
+            out.append(("tggb_dispatch_pending", {}, self.dispatcher.pending()))
+            out.append(("tggb_fair_waiting", {}, self.dispatcher.fair.waiting()))
+        if getattr(self, "sender", None): out.append(("tggb_send_pending", {}, self.sender.pending()))
+        if self.update_log: out.append(("tggb_queue_pending", {}, self.update_log.pending()))
+        out.append(("tggb_album_parts_held", {}, self.albums.pending()))
+        out.append(("tggb_ready", {}, int(lifecycle.ready.is_set())))
+        out.append(("tggb_log_dropped_total", {}, log_writer.dropped))
+        st = self.cache.stats()
+        out += [("tggb_cache_hits_total", {"tier": "mem"}, st["mem_hits"]),
+                ("tggb_cache_hits_total", {"tier": "disk"}, st["disk_hits"]),
+                ("tggb_cache_misses_total", {}, st["misses"]),
+                ("tggb_cache_hit_rate", {}, st["hit_rate"]),
+                ("tggb_cache_disk_bytes", {}, st["disk_bytes"]),
+                ("tggb_singleflight_shared_total", {}, self.flights.shared)]
+        for k in self.key_pool.stats():
+            out += [("tggb_key_tokens", {"key": k["key"]}, k["tokens"]),
+                    ("tggb_key_cooldown_seconds", {"key": k["key"]}, k["cooldown"])]
+        out += [("tggb_breaker_open", {"kind": kind, "name": name}, v) for kind, name, v in self.breakers.stats()]
+        if self.fallback_model:
+            out.append(("tggb_gemini_hedge_budget_seconds", {}, self.hedge_budget(self.model_name)))
+        return out
+
+    def setup_io(self):
+        """Сетевой клиент и диспетчер (у async-движка свои)"""
+        senders = int(os.environ.get("SEND_WORKERS", 4))
+        # Хеджирование — в своём пуле: проигравший запрос висит до таймаута чтения (90 с) и не должен
+        # занимать io_pool. Свободных потоков нет — запрос идёт без дубля, в потоке воркера
+        hedge_threads = int(os.environ.get("HEDGE_THREADS", self.workers * 2))
+        # Сокетов в пулах — по числу потоков, которые ходят в сеть одновременно (у Gemini — воркеры и пул дублей)
+        self.net = HttpPools(pool_specs(bot=self.workers + senders, files=self.workers,
+                                        ai=self.workers + hedge_threads + 2))
+        # Сетевые подзадачи воркера: страницы альбома, прогрев
+        self.io_pool = ThreadPoolExecutor(max_workers=self.workers * 2, thread_name_prefix="io")
+        self.hedge_pool = ThreadPoolExecutor(max_workers=hedge_threads, thread_name_prefix="hedge")
+        self.hedge_slots = BoundedSemaphore(hedge_threads)
+        self.dispatcher = Dispatcher(self.handle_update, workers=self.workers, classify=self.classify,
+                                     on_drop=self.drop_update, **self.fair_params(max(1, self.workers - 2)))
+        # Ответы уходят через свою очередь и своих воркеров — решение задач их не ждёт
+        self.sender = SendQueue(self.tg_url, global_rate=float(os.environ.get("SEND_RATE", 25)))
+        self.sender.start_threads(self.net, workers=senders)
 
     def get_keyboard(self):
         """Интерактивное меню"""
-        return {
-            "inline_keyboard": [
-                [{"text": "📚 Объясни проще", "callback_data": "mode_simple"}, 
-                 {"text": "📝 Режим ЕГЭ/ОГЭ", "callback_data": "mode_ege"}],
-                [{"text": "🔑 Свой ключ (Инструкция)", "callback_data": "tutorial"},
-                 {"text": "🇬🇧 На английский", "callback_data": "mode_en"}]
-            ]
-        }
+        return MAIN_KEYBOARD
+
+    def build_ai_request(self, text, img_bytes=None, sub_mode="standard"):
+        """Запрос к Gemini (общий для обоих движков)"""
+        req = AiRequest(self.prompts, sub_mode, text, img_bytes)
+        self.file_handles.note(req)
+        req.model, req.route = self.router.route(req)
+        return req
+
+    def ai_url(self, api_key, context=None, model=None):
+        # cachedContent есть только в v1beta
+        return self.ai_urls[model or self.model_name, False, bool(context)] + api_key
+
+    def ai_stream_url(self, api_key, context=None, model=None):
+        return self.ai_urls[model or self.model_name, True, bool(context)] + api_key
+
+    def upload_url(self, api_key):
+        return f"{GEMINI_API}/upload/v1beta/files?key={api_key}"
+
+    def context_body(self):
+        return {"model": self.model_name, "systemInstruction": {"parts": [{"text": self.system_instructions}]},
+                "ttl": f"{self.context_ttl}s"}
+
+    def context_known(self, api_key, req):
+        """(известно?, имя кэша): имя "" — Gemini отказал в кэше для этого ключа"""
+        if not self.context_ttl or req.plain: return True, None
+        name = self.contexts.get(api_key, "system")
+        return name is not None, name or None
+
+    def context_saved(self, api_key, r):
+        try:
+            name = r.json()["name"] if r.status_code == 200 else ""
+        except Exception:
+            name = ""
+        metrics.inc("tggb_gemini_contexts_total", result="ok" if name else "refused")
+        if not name: log(f"🗂 [CONTEXT] Кэш контекста не создан ({r.status_code}) — инструкция идёт в запросе")
+        self.contexts.put(api_key, "system", name)
+        return name or None
+
+    def stale_refs(self, api_key, req, uri, context, status):
+        """Файл или кэш истёк (400/403/404 на запрос со ссылкой) — забываем и шлём всё в запросе"""
+        if not (uri or context) or status not in (400, 403, 404): return False
+        log(f"🗂 [FILES] Ссылка на файл/кэш не принята ({status}) — повтор без ссылок")
+        if uri: self.file_handles.forget(api_key, req.digest)
+        if context: self.contexts.forget(api_key, "system")
+        req.plain = True
+        return True
+
+    def live_model(self, req):
+        """Модель запроса (дешёвая или основная), а если её цепь разомкнута — следующая; None — все недоступны"""
+        chain = (req.model, self.model_name) if req.model else (self.model_name, self.fallback_for(req))
+        for model in chain:
+            if model and self.breakers.allow("model", model): return model
+        metrics.inc("tggb_gemini_short_circuit_total")
+        return None
+
+    def fallback_for(self, req):
+        """Запасная модель запроса. Эскалированный запрос в дешёвую модель не откатываем: её ответ
+        уже не прошёл проверку, а ответ запасной идёт пользователю без Router.accept"""
+        if req.escalated and self.fallback_model == self.router.cheap_model: return None
+        return self.fallback_model
+
+    def hedge_budget(self, model):
+        """Сколько ждать основную модель до дубля в запасную: p95 её ответов (пока данных мало — 30 с)"""
+        window = self.latency.get(model)
+        return max(self.hedge_min, (window and window.p95()) or 30.0)
+
+    def ai_outcome(self, api_key, model, status, seconds, stream=False):
+        """Учёт ответа Gemini: метрики, предохранители ключа и модели, окно задержек"""
+        labels = {"stream": 1} if stream else {}
+        metrics.inc("tggb_gemini_responses_total", status=status, model=model.rsplit("/", 1)[-1], **labels)
+        log(f"🤖 [AI] {model.rsplit('/', 1)[-1]}: {status}" + ("" if stream else f" за {seconds:.2f} с"),
+            model=model.rsplit("/", 1)[-1], status=status, **({"stream": True} if stream else {"seconds": round(seconds, 3)}))
+        failed = status == "exception" or status in TRANSIENT
+        self.breakers.record("model", model, not failed)
+        if api_key in self.key_pool.by_key: self.breakers.record("key", api_key, not failed)
+        if status == "exception" or stream: return
+        metrics.observe("tggb_gemini_seconds", seconds, model=model.rsplit("/", 1)[-1])
+        if status == 200: self.latency.setdefault(model, LatencyWindow()).add(seconds)
+
+    def usable_keys(self):
+        """Ключи пула с разомкнутой цепью — их не берём; все выключены — сразу ошибка"""
+        skip = {k for k in self.key_pool.by_key if not self.breakers.allow("key", k)}
+        if skip and len(skip) == len(self.key_pool.by_key): return None
+        return skip
+
+    def parse_ai_answer(self, r, model=None):
+        """Разбор ответа Gemini (у requests и httpx одинаковый интерфейс)"""
+        if r.status_code == 429: return "LIMIT_ERROR"
+        if r.status_code != 200: return "ERROR"
+        data = r.json()
+        record_usage(model or self.model_name, data.get("usageMetadata"))
+        return data['candidates'][0]['content']['parts'][0]['text']
 
     def call_ai(self, text, img_bytes=None, user_id=None, sub_mode="standard"):
         """Запрос к ИИ с поддержкой BYOK"""
-        active_key = user_keys.get(user_id, self.admin_key)
-        
-        instruction = self.system_instructions
-        if sub_mode == "mode_simple": instruction += "\nУпрости объяснение до максимума."
-        elif sub_mode == "mode_ege": instruction += "\nСделай акцент на оформлении для ЕГЭ/ОГЭ."
-        elif sub_mode == "mode_en": instruction += "\nПереведи решение на английский язык."
-
-        parts = [{"text": f"{instruction}\n\nЗАДАЧА: {text}"}]
-        if img_bytes:
-            parts.append({"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(img_bytes).decode()}})
-        
-        payload = {"contents": [{"parts": parts}], "generationConfig": {"temperature": 0.3}}
-        api_url = f"https://generativelanguage.googleapis.com/v1/{self.model_name}:generateContent?key={active_key}"
+        key = self.cache.key(self.model_name, text, sub_mode, img_bytes)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        own_key = user_keys.get(user_id)
+        ans, leader = self.flights.do(flight_key(text, sub_mode, img_bytes),
+                                      lambda: self.ask_gemini(self.build_ai_request(text, img_bytes, sub_mode), own_key),
+                                      own_key)
+        if leader and ans not in ("ERROR", "LIMIT_ERROR"): self.cache.put(key, ans)
+        return ans
+
+    def ask_gemini(self, req, own_key=None, post=None):
+        """Запрос по модели от Router; ответ дешёвой не прошёл проверку — повтор на основной"""
+        ans = self.ask_pool(req, own_key, post)
+        if not req.model or ans == "LIMIT_ERROR" or self.router.accept(ans): return ans
+        metrics.inc("tggb_route_escalations_total", reason=req.route)
+        req.model = None
+        req.escalated = True
+        return self.ask_pool(req, own_key, post)
+
+    def ask_pool(self, req, own_key=None, post=None):
+        """Личный ключ — напрямую; иначе ключ из пула и одна повторная попытка на другом после 429"""
+        post = post or self.post_hedged
+        if own_key:
+            return post(own_key, req)
+        tried = self.usable_keys()
+        if tried is None: return "ERROR"
+        for _ in range(2):
+            api_key, wait = self.key_pool.acquire(exclude=tried)
+            if not api_key: break
+            tried.add(api_key)
+            if wait: time.sleep(wait)
+            ans = post(api_key, req)
+            if ans != "LIMIT_ERROR": return ans
+        return "LIMIT_ERROR"
 
+    def image_uri(self, api_key, req):
+        """URI картинки в Files API (загрузка один раз на ключ); None — слать inline"""
+        if not self.file_handles.wanted(req): return None
+        uri = self.file_handles.get(api_key, req.digest)
+        if uri:
+            metrics.inc("tggb_gemini_uploads_total", result="reused")
+            return uri
+        t = time.perf_counter()
         try:
-            r = self.session.post(api_url, json=payload, timeout=90)
-            if r.status_code == 429: return "LIMIT_ERROR"
-            if r.status_code != 200: return "ERROR"
-            return r.json()['candidates'][0]['content']['parts'][0]['text']
-        except:
-            return "ERROR"
+            r = self.net.post("ai", self.upload_url(api_key), data=req.img, headers=UPLOAD_HEADERS)
+            uri = r.json()["file"]["uri"]
+        except Exception as e:
+            metrics.inc("tggb_gemini_uploads_total", result="error")
+            log(f"🛑 [FILES] Загрузка картинки не удалась: {e}")
+            return None
+        metrics.observe("tggb_gemini_upload_seconds", time.perf_counter() - t)
+        metrics.inc("tggb_gemini_uploads_total", result="ok")
+        self.file_handles.put(api_key, req.digest, uri)
+        return uri
 
-    def send_smart_msg(self, chat_id, text, with_kb=True):
-        """Деление длинных сообщений и отправка"""
-        limit = 3800
-        parts = [text[i:i + limit] for i in range(0, len(text), limit)]
-        for i, part in enumerate(parts):
+    def context_name(self, api_key, req):
+        """Имя кэша контекста с общей инструкцией (создаётся один раз на ключ); None — без кэша"""
+        known, name = self.context_known(api_key, req)
+        if known: return name
+        try:
+            r = self.net.post("ai", f"{GEMINI_API}/v1beta/cachedContents?key={api_key}", json=self.context_body())
+        except Exception as e:
+            log(f"🛑 [CONTEXT] {e}")
+            return None
+        return self.context_saved(api_key, r)
+
+    def post_hedged(self, api_key, req):
+        """Основная модель; не ответила за p95 — тот же запрос параллельно уходит в запасную, берём первый ответ"""
+        model = self.live_model(req)
+        if not model: return "ERROR"
+        fallback = self.fallback_for(req)
+        if model != self.model_name or not fallback: return self.post_ai(api_key, req, model)
+        first = self.hedge_submit(api_key, req, model)
+        if first is None:
+            metrics.inc("tggb_gemini_hedge_skipped_total")
+            return self.post_ai(api_key, req, model)
+        try:
+            return first.result(timeout=self.hedge_budget(model))
+        except FutureTimeout:
+            pass
+        if not self.breakers.allow("model", fallback): return first.result()
+        second = self.hedge_submit(api_key, req, fallback)
+        if second is None:
+            metrics.inc("tggb_gemini_hedge_skipped_total")
+            return first.result()
+        metrics.inc("tggb_gemini_hedges_total")
+        # Проигравший запрос дорабатывает в своём потоке, его ответ просто не нужен
+        pending, ans = {first, second}, "ERROR"
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                ans = fut.result()
+                if ans not in ("ERROR", "LIMIT_ERROR"):
+                    metrics.inc("tggb_gemini_hedge_wins_total", model="fallback" if fut is second else "primary")
+                    return ans
+        return ans
+
+    def hedge_submit(self, api_key, req, model):
+        """post_ai в пуле хеджирования, если там есть свободный поток (счёт слотов — без очереди,
+        иначе бюджет p95 включал бы ожидание); None — пул занят"""
+        if not self.hedge_slots.acquire(blocking=False): return None
+        fut = self.hedge_pool.submit(contextvars.copy_context().run, self.post_ai, api_key, req, model)
+        fut.add_done_callback(lambda f: self.hedge_slots.release())
+        return fut
+
+    def post_ai(self, api_key, req, model=None):
+        model = model or self.model_name
+        uri = self.image_uri(api_key, req)
+        # Кэш контекста создан под основную модель
+        ctx = self.context_name(api_key, req) if model == self.model_name else None
+        for attempt in range(self.ai_retries + 1):
+            if attempt:
+                if not self.breakers.allow("model", model): break
+                metrics.inc("tggb_gemini_retries_total")
+                time.sleep(backoff_delay(attempt))
+            t = time.perf_counter()
+            try:
+                r = self.net.post("ai", self.ai_url(api_key, ctx, model), data=req.body(uri, ctx), headers=JSON_HEADERS)
+            except requests.RequestException as e:
+                self.ai_outcome(api_key, model, "exception", time.perf_counter() - t)
+                log(f"⚠️ [AI] {model}: {type(e).__name__}")
+                if transient_error(e): continue
+                return "ERROR"
+            self.ai_outcome(api_key, model, r.status_code, time.perf_counter() - t)
+            if r.status_code in TRANSIENT: continue
+            if self.stale_refs(api_key, req, uri, ctx, r.status_code): return self.post_ai(api_key, req, model)
+            self.key_pool.report(api_key, r.status_code, retry_after_of(r) if r.status_code == 429 else None)
+            try:
+                return self.parse_ai_answer(r, model)
+            except (ValueError, KeyError, IndexError):
+                return "ERROR"
+        return "ERROR"
+
+    def solve_streaming(self, chat_id, text, img_bytes=None, user_id=None, sub_mode="standard"):
+        """Ответ ИИ по мере генерации: одно сообщение, которое дописывается через editMessageText"""
+        key = self.cache.key(self.model_name, text, sub_mode, img_bytes)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.send_smart_msg(chat_id, cached)
+            return cached
+        own_key = user_keys.get(user_id)
+
+        def stream():
+            reply = StreamReply(chat_id, interval=self.stream_interval)
+            self.apply_stream_ops(reply, reply.ops(""))
+            on_text = lambda so_far: self.apply_stream_ops(reply, reply.ops(so_far))
+            req = self.build_ai_request(text, img_bytes, sub_mode)
+            ans = self.ask_gemini(req, own_key, post=lambda api_key, r: self.post_ai_stream(api_key, r, on_text))
+            if ans in ("ERROR", "LIMIT_ERROR"):
+                self.apply_stream_ops(reply, reply.abort_ops())
+                return ans
+            self.apply_stream_ops(reply, reply.ops(ans, final=True, keyboard=self.get_keyboard()))
+            self.cache.put(key, ans)
+            return ans
+
+        # Такую же задачу уже печатают в другом чате — дожидаемся и шлём готовый ответ
+        ans, leader = self.flights.do(flight_key(text, sub_mode, img_bytes), stream, own_key)
+        if not leader and ans not in ("ERROR", "LIMIT_ERROR"): self.send_smart_msg(chat_id, ans)
+        return ans
+
+    def post_ai_stream(self, api_key, req, on_text):
+        """streamGenerateContent (SSE): on_text получает весь накопленный текст.
+        Без хеджирования — напечатанное уже видно пользователю; повтор — только пока ничего не показано."""
+        model = self.live_model(req)
+        if not model: return "ERROR"
+        uri = self.image_uri(api_key, req)
+        ctx = self.context_name(api_key, req) if model == self.model_name else None
+        for attempt in range(self.ai_retries + 1):
+            if attempt:
+                if not self.breakers.allow("model", model): break
+                metrics.inc("tggb_gemini_retries_total", stream=1)
+                time.sleep(backoff_delay(attempt))
+            chunks, usage = [], None
+            t = time.perf_counter()
+            try:
+                with self.net.post("ai", self.ai_stream_url(api_key, ctx, model), data=req.body(uri, ctx),
+                                   headers=JSON_HEADERS, stream=True) as r:
+                    self.ai_outcome(api_key, model, r.status_code, 0, stream=True)
+                    if r.status_code in TRANSIENT or self.stale_refs(api_key, req, uri, ctx, r.status_code):
+                        r.content  # дочитываем ошибку, чтобы соединение вернулось в пул
+                        if r.status_code in TRANSIENT: continue
+                        return self.post_ai_stream(api_key, req, on_text)
+                    self.key_pool.report(api_key, r.status_code, retry_after_of(r) if r.status_code == 429 else None)
+                    if r.status_code == 429: return "LIMIT_ERROR"
+                    if r.status_code != 200: return "ERROR"
+                    # chunk_size=None — отдаём куски сразу, как пришли, без буферизации
+                    for line in r.iter_lines(chunk_size=None):
+                        piece, event_usage = parse_sse_chunk(line.decode("utf-8"))
+                        usage = event_usage or usage
+                        if piece:
+                            if not chunks:
+                                metrics.observe("tggb_gemini_first_chunk_seconds", time.perf_counter() - t,
+                                                model=model.rsplit("/", 1)[-1])
+                            chunks.append(piece)
+                            on_text("".join(chunks))
+            except requests.RequestException as e:
+                self.ai_outcome(api_key, model, "exception", 0, stream=True)
+                log(f"⚠️ [AI] {model}: {type(e).__name__}")
+                if not chunks and transient_error(e): continue
+                return "ERROR"
+            except Exception as e:
+                log(f"🛑 [AI] Поток ответа прерван: {e}")
+                return "ERROR"
+            metrics.observe("tggb_gemini_seconds", time.perf_counter() - t, model=model.rsplit("/", 1)[-1], stream=1)
+            record_usage(model, usage)
+            return "".join(chunks) or "ERROR"
+        return "ERROR"
+
+    def apply_stream_ops(self, reply, ops):
+        # Через общую очередь: правки подчиняются тем же лимитам, а message_id нужен сразу
+        futures = [(i, body, self.sender.submit(reply.chat_id, method, body)) for method, i, body in ops]
+        for i, body, fut in futures:
+            result = fut.result()
+            if result is not None: reply.done(i, body, result)
+
+    def build_messages(self, chat_id, text, with_kb=True):
+        """Деление длинных сообщений на куски до 3800 символов по абзацам, не разрывая разметку"""
+        parts = render_chunks(text, 3800)
+        payloads = []
+        for i, (part, parse_mode) in enumerate(parts):
             is_last = (i == len(parts) - 1)
             payload = {
                 "chat_id": chat_id,
                 "text": part,
-                "parse_mode": "Markdown",
                 "reply_markup": self.get_keyboard() if (is_last and with_kb) else None
             }
+            if parse_mode: payload["parse_mode"] = parse_mode
+            payloads.append(payload)
+        return payloads
+
+    def send_smart_msg(self, chat_id, text, with_kb=True):
+        """Деление длинных сообщений и постановка в очередь отправки"""
+        for payload in self.build_messages(chat_id, text, with_kb):
+            self.sender.submit(chat_id, "sendMessage", payload)
+
+    def fair_params(self, slots):
+        """Планировщик: AI_SLOTS — одновременных задач на общих ключах, AI_PER_CHAT — очередь чата,
+        AI_DEADLINE — через сколько секунд задача уже не нужна"""
+        return {"shared_slots": int(os.environ.get("AI_SLOTS", slots)),
+                "per_chat": int(os.environ.get("AI_PER_CHAT", 10)),
+                "deadline": float(os.environ.get("AI_DEADLINE", 180))}
+
+    def classify(self, upd):
+        """(цена, через общие ключи?) — фото дороже текста, владельцы своих ключей мимо общей полосы"""
+        if "callback_query" in upd:
+            cb = upd["callback_query"]
+            if cb.get("data") == "tutorial": return 0.1, False
+            chat_id = cb["message"]["chat"]["id"]
+            st = self.states.get(chat_id)
+            pages = len(image_pages(st.img_data)) if st else 0
+        else:
+            msg = upd.get("message") or {}
+            chat_id = msg.get("chat", {}).get("id")
+            text = msg.get("text", "")
+            pages = len(msg.get("photos") or ()) or int("photo" in msg)
+            if not pages and (not text or text == "/start" or text.strip().startswith("AIza")):
+                return 0.1, False
+        cost = self.image_cost * pages if pages else 1
+        return cost, user_keys.get(chat_id) is None
+
+    def drop_update(self, upd, reason):
+        """Апдейт снят планировщиком: чат завалил очередь (busy) или задача устарела (stale)"""
+        self.note_drop(upd, reason)
+        if self.update_log: self.update_log.ack(upd["update_id"])
+
+    def note_drop(self, upd, reason):
+        chat_id = self.chat_of(upd)
+        metrics.inc("tggb_dropped_total", reason=reason)
+        log(f"🚧 [SCHED] {chat_id}: апдейт {upd['update_id']} снят ({reason})")
+        if chat_id is not None:
+            self.sender.submit(chat_id, "sendMessage", {"chat_id": chat_id, "text": BUSY_TEXT if reason == "busy" else STALE_TEXT})
+
+    def chat_of(self, upd):
+        """chat_id апдейта — ключ очереди диспетчера"""
+        if "callback_query" in upd:
+            return upd["callback_query"]["message"]["chat"]["id"]
+        msg = upd.get("message") or {}
+        return msg.get("chat", {}).get("id")
+
+    def handle_update(self, upd):
+        """Обработка одного апдейта (выполняется в воркере диспетчера)"""
+        if "callback_query" in upd:
+            cb = upd["callback_query"]
+            uid = cb["message"]["chat"]["id"]
+            self.net.post("bot", self.tg_url + "answerCallbackQuery", json={"callback_query_id": cb["id"]})
+
+            if cb["data"] == "tutorial":
+                self.send_smart_msg(uid, TUTORIAL_TEXT, with_kb=False)
+            else:
+                st = self.states.get(uid)
+                if not st:
+                    self.send_smart_msg(uid, NO_TASK_TEXT, with_kb=False)
+                    return
+                # Та же задача и то же фото, только другой режим — без повторного getFile
+                res = self.call_ai(st.prompt, st.img_data, user_id=uid, sub_mode=cb["data"])
+                self.send_smart_msg(uid, "🔄 **ОБНОВЛЕНИЕ:**\n\n" + res)
+            return
+
+        msg = upd.get("message")
+        if not msg: return
+        chat_id = msg["chat"]["id"]
+        text = msg.get("text", "")
+
+        if text == "/start":
+            self.send_smart_msg(chat_id, WELCOME_TEXT, with_kb=False)
+            return
+
+        if text.strip().startswith("AIza"):
+            user_keys[chat_id] = text.strip()
+            self.send_smart_msg(chat_id, KEY_OK_TEXT, with_kb=False)
+            return
+
+        timer = StageTimer()
+        img_data = None
+        photos = msg.get("photos") or ([msg["photo"]] if "photo" in msg else [])
+        if photos:
+            log(f"📸 Фото от {chat_id}" + (f" (альбом, {len(photos)} шт.)" if len(photos) > 1 else ""),
+                chat=chat_id, pages=len(photos))
+            img_data = self.fetch_photo(photos, timer)
+
+        prompt = msg.get("text", msg.get("caption", "Реши задачу"))
+        self.sender.chat_action(chat_id)
+
+        if self.streaming:
+            # Ответ уже у пользователя — отправлять нужно только ошибки
+            ans = self.solve_streaming(chat_id, prompt, img_data, user_id=chat_id)
+        else:
+            ans = self.call_ai(prompt, img_data, user_id=chat_id)
+        timer.lap("ai")
+
+        if ans == "LIMIT_ERROR":
+            self.send_smart_msg(chat_id, LIMIT_TEXT, with_kb=True)
+        elif ans == "ERROR":
+            self.send_smart_msg(chat_id, ERROR_TEXT, with_kb=False)
+        else:
+            self.states.put(chat_id, prompt, img_data, ans)
+            if not self.streaming: self.send_smart_msg(chat_id, ans)
+        timer.lap("send")
+        log(f"⏱ [TIMING] {chat_id}: {timer.summary()}", chat=chat_id, stages=timer.fields())
+
+    def fetch_photo(self, photos, timer):
+        """Снимок задачи; страницы альбома качаются и сжимаются параллельно и возвращаются tuple"""
+        if len(photos) == 1: return self.fetch_page(photos[0], timer)
+        # У каждой страницы своя копия контекста (trace апдейта): один контекст нельзя войти из двух потоков
+        pages = tuple(f.result() for f in [self.io_pool.submit(contextvars.copy_context().run, self.fetch_page, p)
+                                           for p in photos])
+        timer.lap("album", sum(map(len, pages)))
+        return pages
+
+    def fetch_page(self, sizes, timer=None):
+        """getFile -> скачивание -> сжатие (в пуле процессов)"""
+        photo = pick_photo(sizes)
+        f_info = self.net.get("bot", self.tg_url + "getFile", params={"file_id": photo["file_id"]}).json()
+        if timer: timer.lap("getFile")
+        raw = self.net.get("files", f"{TELEGRAM_API}/file/bot{self.tg_token}/{f_info['result']['file_path']}").content
+        if timer: timer.lap("download", len(raw))
+        if image_ready(raw):
+            img_data = raw
+        elif self.image_pool:
+            img_data = self.image_pool.submit(prepare_image, raw).result()
+        else:
+            img_data = prepare_image(raw)
+        if timer: timer.lap("image", len(img_data))
+        return img_data
+
+    def warm_calls(self):
+        """Прогревочные GET (пул, адрес): по одному на соединение, которое стоит открыть заранее.
+        WARM_CONNECTIONS — сколько соединений открыть в пулах bot, files и ai"""
+        n = int(os.environ.get("WARM_CONNECTIONS", 2))
+        calls = [("poll", self.tg_url + "getMe")] + [("bot", self.tg_url + "getMe"), ("files", self.tg_url + "getMe")] * n
+        key = next(iter(self.key_pool.by_key), None)
+        if key: calls += [("ai", f"{GEMINI_API}/v1beta/{self.model_name}?key={key}")] * n
+        return calls
+
+    def warm_done(self, jobs, results, t):
+        failed = {name: res for name, res in zip(jobs, results) if isinstance(res, Exception)}
+        for name, e in failed.items():
+            log(f"⚠️ [WARM] {name}: {e}")
+        opened = ", ".join(f"{name}×{jobs.count(name)}" for name in dict.fromkeys(jobs))
+        log(f"🔥 [SYS] Прогрев: {opened} за {time.perf_counter() - t:.2f} с")
+
+    def warm(self):
+        """Прогрев до готовности: соединения пулов открыты (TLS не на первом апдейте), процессы пула
+        картинок подняты, Pillow загружен. Ошибки прогрева не мешают работе — только логируются"""
+        t = time.perf_counter()
+        # Параллельно: каждый запрос займёт своё соединение, и все они останутся в пуле
+        futures = [(pool, self.io_pool.submit(self.net.get, pool, url, timeout=10)) for pool, url in self.warm_calls()]
+        if self.image_warm: futures.append(("images", self.image_warm))
+        Image.init()
+        results = []
+        for _, fut in futures:
             try:
-                self.session.post(self.tg_url + "sendMessage", json=payload)
-            except:
-                payload.pop("parse_mode", None)
-                self.session.post(self.tg_url + "sendMessage", json=payload)
+                results.append(fut.result(timeout=30))
+            except Exception as e:
+                results.append(e)
+        self.warm_done([name for name, _ in futures], results, t)
 
     def run(self):
-        log("🛰 [SYS] Бот запущен и слушает...")
-        while True:
-            try:
-                r = self.session.get(self.tg_url + "getUpdates", params={"offset": self.offset, "timeout": 20}).json()
-                for upd in r.get("result", []):
-                    self.offset = upd["update_id"] + 1
-                    
-                    if "callback_query" in upd:
-                        cb = upd["callback_query"]
-                        uid = cb["message"]["chat"]["id"]
-                        self.session.post(self.tg_url + "answerCallbackQuery", json={"callback_query_id": cb["id"]})
-                        
-                        if cb["data"] == "tutorial":
-                            t_msg = ("🔑 **ИНСТРУКЦИЯ ПО КЛЮЧУ**\n\n"
-                                     "1. Зайди на [Google AI Studio](https://aistudio.google.com/app/apikey)\n"
-                                     "2. Создай бесплатный API Key.\n"
-                                     "3. Просто **пришли его мне** сообщением.\n\n"
-                                     "Это снимет любые лимиты!")
-                            self.send_smart_msg(uid, t_msg, with_kb=False)
-                        else:
-                            res = self.call_ai("Обнови решение", user_id=uid, sub_mode=cb["data"])
-                            self.send_smart_msg(uid, "🔄 **ОБНОВЛЕНИЕ:**\n\n" + res)
+        log(f"🛰 [SYS] Бот запущен и слушает... (воркеров: {self.dispatcher.workers})")
+        self.warm()
+        self.delete_webhook()
+        if self.update_log:
+            self.offset = self.update_log.offset()
+            Thread(target=self.run_worker, daemon=True).start()
+        Thread(target=self.flush_albums, daemon=True).start()
+        lifecycle.mark_ready("long polling")
+        try:
+            while not lifecycle.stopping.is_set():
+                try:
+                    # Long poll обрывается по SIGTERM сразу (Shutdown), а не через 20 секунд
+                    r = lifecycle.wait(self.net.get, "poll", self.tg_url + "getUpdates",
+                                       params={"offset": self.offset, "timeout": LONG_POLL}).json()
+                    batch = self.updates_of(r)
+                    # Части альбомов ждут остальные в AlbumBuffer и уйдут в работу из flush_albums
+                    # (с QUEUE_DB буфер пропускает всё сразу — альбомы склеивает UpdateLog)
+                    ready = self.albums.hold(batch)
+                    if self.update_log and batch:
+                        # Offset сохраняется в той же транзакции, что и апдейты
+                        if ready: self.update_log.append(ready, self.chat_of)
+                        self.offset = batch[-1]["update_id"] + 1
                         continue
+                    for upd in ready:
+                        # Offset сдвигаем только после того, как апдейт принят диспетчером
+                        self.dispatcher.submit(self.chat_of(upd), upd)
+                        self.offset = upd["update_id"] + 1
+                    if batch: self.offset = batch[-1]["update_id"] + 1
 
-                    msg = upd.get("message")
-                    if not msg: continue
-                    chat_id = msg["chat"]["id"]
-                    text = msg.get("text", "")
+                except Exception as e:
+                    log(f"🛑 [LOOP ERROR] {e}")
+                    lifecycle.wait(time.sleep, 5)
+        except Shutdown:
+            pass
+        self.shutdown()
+        self.confirm_offset()
 
-                    if text == "/start":
-                        welcome = ("👋 **Привет! Я твой личный ГДЗ-помощник.**\n\n"
-                                   "Я использую **Gemini 2.5 Flash**, чтобы решать задачи по фото.\n"
-                                   "📸 Просто пришли мне фото или напиши условие.")
-                        self.send_smart_msg(chat_id, welcome, with_kb=False)
-                        continue
+    def confirm_offset(self):
+        """Последний getUpdates сообщает Telegram offset: иначе новый инстанс снова получит последнюю пачку.
+        Пачки до неё Telegram считает доставленными с прошлого опроса — их сохраняет только дренаж"""
+        offset = self.offset
+        try:
+            self.net.get("poll", self.tg_url + "getUpdates", params={"offset": offset, "timeout": 0, "limit": 1})
+            log(f"💾 [SYS] Offset {offset} подтверждён")
+        except Exception as e:
+            log(f"🛑 [SHUTDOWN ERROR] offset {offset}: {e}")
 
-                    if text.strip().startswith("AIza"):
-                        user_keys[chat_id] = text.strip()
-                        self.send_smart_msg(chat_id, "✅ **Ключ привязан!** Теперь я работаю на твоих лимитах.", with_kb=False)
-                        continue
+    def delete_webhook(self):
+        """Вебхук от прошлого деплоя (WEBHOOK_URL) снимаем до опроса — иначе getUpdates отвечает 409"""
+        try:
+            r = self.net.post("bot", self.tg_url + "deleteWebhook").json()
+            log(f"🪝 [SYS] deleteWebhook: {r.get('description', r.get('ok'))}")
+        except Exception as e:
+            log(f"🛑 [WEBHOOK ERROR] deleteWebhook: {e}")
 
-                    img_data = None
-                    if "photo" in msg:
-                        log(f"📸 Фото от {chat_id}")
-                        fid = msg["photo"][-1]["file_id"]
-                        f_info = self.session.get(self.tg_url + "getFile", params={"file_id": fid}).json()
-                        raw = self.session.get(f"https://api.telegram.org/file/bot{self.tg_token}/{f_info['result']['file_path']}").content
-                        img = Image.open(io.BytesIO(raw)).convert('RGB')
-                        img.thumbnail((1600, 1600))
-                        buf = io.BytesIO()
-                        img.save(buf, format="JPEG", quality=85)
-                        img_data = buf.getvalue()
-
-                    prompt = msg.get("text", msg.get("caption", "Реши задачу"))
-                    self.session.post(self.tg_url + "sendChatAction", json={"chat_id": chat_id, "action": "typing"})
-                    
-                    ans = self.call_ai(prompt, img_data, user_id=chat_id)
-
-                    if ans == "LIMIT_ERROR":
-                        err = "⚠️ **Лимиты бота исчерпаны.**\nДобавь свой бесплатный ключ по кнопке ниже!"
-                        self.send_smart_msg(chat_id, err, with_kb=True)
-                    elif ans == "ERROR":
-                        self.send_smart_msg(chat_id, "❌ Ошибка. Попробуй другое фото.", with_kb=False)
-                    else:
-                        self.send_smart_msg(chat_id, ans)
+    def updates_of(self, r):
+        """Апдейты из ответа getUpdates; отказ (409 при вебхуке, 401, 5xx) — ошибка, цикл опроса ждёт и повторяет"""
+        if not r.get("ok"):
+            raise RuntimeError(f"getUpdates {r.get('error_code')}: {r.get('description')}")
+        return r.get("result", [])
+
+    def webhook_params(self):
+        params = {"url": WEBHOOK_URL.rstrip("/") + "/webhook",
+                  "allowed_updates": ["message", "callback_query"],
+                  "max_connections": 100}
+        if WEBHOOK_SECRET: params["secret_token"] = WEBHOOK_SECRET
+        return params
 
+    def run_webhook(self):
+        """Приём апдейтов через POST /webhook вместо getUpdates"""
+        self.warm()
+        try:
+            r = self.net.post("bot", self.tg_url + "setWebhook", json=self.webhook_params()).json()
+            log(f"🪝 [SYS] Вебхук {WEBHOOK_URL}: {r.get('description', r.get('ok'))}")
+        except Exception as e:
+            # Вебхук мог поставить другой инстанс — очередь всё равно слушаем
+            log(f"🛑 [WEBHOOK ERROR] setWebhook: {e}")
+        if self.update_log: Thread(target=self.run_worker, daemon=True).start()
+        Thread(target=self.flush_albums, daemon=True).start()
+        lifecycle.mark_ready("webhook")
+        while not lifecycle.stopping.is_set():
+            try:
+                upd = update_queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                for ready in self.albums.hold([upd]): self.enqueue(ready)
+                self.offset = max(self.offset, upd["update_id"] + 1)
             except Exception as e:
-                log(f"🛑 [LOOP ERROR] {e}")
-                time.sleep(5)
+                log(f"🛑 [WEBHOOK ERROR] {e}")
+        self.shutdown()
 
-if __name__ == "__main__":
-    Thread(target=run_web, daemon=True).start()
-    UltraGdzBot().run()
-        self.tg_url = f"https://api.telegram.org/bot{self.tg_token}/"
-        # Самая мощная модель для 2026 года
-        self.model_name = "models/gemini-2.0-flash" 
-        self.offset = 0
-        self.session = requests.Session()
-        
-        # 10 идей внедрены в этот промпт
-        self.system_instructions = (
-            "Ты — элитный ИИ-репетитор. Твои правила:\n"
-            "1. Решай всё по фото (текст, формулы, почерк).\n"
-            "2. Формат: **Дано**, **Решение**, **Ответ**.\n"
-            "3. Режим ЕГЭ: давай подсказки по правильному оформлению.\n"
-            "4. В конце пиши '🎥 Рекомендую темы для YouTube: ...' (идея №8).\n"
-            "5. Используй LaTeX символы и жирный шрифт для scannability.\n"
-            "6. Объясняй логику решения максимально понятно."
-        )
+    def enqueue(self, upd):
+        """Апдейт в работу: в общую очередь QUEUE_DB или прямо диспетчеру"""
+        if self.update_log: self.update_log.append([upd], self.chat_of)
+        else: self.dispatcher.submit(self.chat_of(upd), upd)
 
-    def get_main_keyboard(self):
-        """Интерактивное меню под сообщениями"""
-        return {
-            "inline_keyboard": [
-                [{"text": "📚 Объясни проще", "callback_data": "mode_simple"}, 
-                 {"text": "📝 Режим ЕГЭ/ОГЭ", "callback_data": "mode_ege"}],
-                [{"text": "🔑 Добавить свой ключ", "callback_data": "tutorial"},
-                 {"text": "🇬🇧 На английский", "callback_data": "mode_en"}]
-            ]
-        }
-
-    def call_gemini_ai(self, text, img_bytes=None, user_id=None, sub_mode="standard"):
-        """Ядро ИИ с поддержкой личных ключей и ротации"""
-        # Используем личный ключ юзера или основной админский
-        active_key = user_keys.get(user_id, self.admin_key)
-        
-        instruction = self.system_instructions
-        if sub_mode == "mode_simple": instruction += "\nМаксимально упрости объяснение."
-        elif sub_mode == "mode_ege": instruction += "\nОформи строго по критериям госэкзаменов."
-        elif sub_mode == "mode_en": instruction += "\nПереведи всё решение на английский язык."
-
-        parts = [{"text": f"{instruction}\n\nЗАДАЧА: {text}"}]
-        if img_bytes:
-            parts.append({"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(img_bytes).decode()}})
-        
-        payload = {"contents": [{"parts": parts}], "generationConfig": {"temperature": 0.3}}
-        api_url = f"https://generativelanguage.googleapis.com/v1/{self.model_name}:generateContent?key={active_key}"
+    def flush_albums(self):
+        """Собранные альбомы — в работу, когда новых частей больше не приходит"""
+        while not lifecycle.stopping.is_set():
+            time.sleep(self.albums.tick)
+            for upd in self.albums.due():
+                try:
+                    self.enqueue(upd)
+                except Exception as e:
+                    log(f"🛑 [ALBUM ERROR] {e}")
 
-        try:
-            r = self.session.post(api_url, json=payload, timeout=90)
-            if r.status_code == 429:
-                return "LIMIT_ERROR"
-            if r.status_code != 200:
-                return "ERROR"
-            return r.json()['candidates'][0]['content']['parts'][0]['text']
-        except Exception as e:
-            log(f"🛑 [AI ERROR] {e}")
-            return "ERROR"
-
-    def send_smart_message(self, chat_id, text, with_kb=True):
-        """Разбивка длинных сообщений (идея №7) и отправка"""
-        limit = 3800
-        text_parts = [text[i:i + limit] for i in range(0, len(text), limit)]
-        
-        for i, part in enumerate(text_parts):
-            is_last_part = (i == len(text_parts) - 1)
-            payload = {
-                "chat_id": chat_id,
-                "text": part,
-                "parse_mode": "Markdown",
-                "reply_markup": self.get_main_keyboard() if (is_last_part and with_kb) else None
-            }
+    def leftovers(self):
+        """Принятое, но не отданное в работу к остановке: апдейты из очереди вебхука и недособранные альбомы"""
+        late = []
+        while True:
+            try:
+                late.append(update_queue.get_nowait())
+            except Empty:
+                break
+        return self.albums.hold(late) + self.albums.due(force=True)
+
+    def shutdown(self):
+        """Приём уже закрыт: доделываем начатое до DRAIN_TIMEOUT, аренды QUEUE_DB отпускаем"""
+        deadline = time.monotonic() + lifecycle.drain_timeout
+        for upd in self.leftovers():
             try:
-                self.session.post(self.tg_url + "sendMessage", json=payload, timeout=30)
-            except:
-                # Если Markdown вызвал ошибку, шлем чистым текстом
-                payload.pop("parse_mode", None)
-                self.session.post(self.tg_url + "sendMessage", json=payload, timeout=30)
-
-    def run_polling(self):
-        log("🛰 [READY] Бот начал опрос Telegram...")
+                self.enqueue(upd)
+                self.offset = max(self.offset, upd["update_id"] + 1)
+            except Exception as e:
+                log(f"🛑 [SHUTDOWN ERROR] {e}")
+        while (self.dispatcher.pending() or self.sender.pending()) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        lifecycle.unfinished = self.dispatcher.pending() + self.sender.pending()
+        if self.update_log:
+            released = self.update_log.release_owner(self.queue_owner)
+            if released: log(f"🧵 [QUEUE] Отпущено апдейтов: {released}")
+        # Явно: в процессе-воркере multiprocessing при выходе иначе вечно ждёт процессы пула картинок
+        if self.image_pool: self.image_pool.shutdown(cancel_futures=True)
+        log(f"👋 [SYS] Остановка: не доделано задач {lifecycle.unfinished}")
+
+    def run_worker(self, parent=None):
+        """Воркер общей очереди QUEUE_DB: головы чатов -> диспетчер -> подтверждение после обработки"""
+        owner = self.queue_owner
+        self.dispatcher.handler = self.handle_queued
+        log(f"🧵 [QUEUE] Воркер {owner} разбирает {self.update_log.path}")
+        # Процесс из QUEUE_WORKERS завершается вместе с родителем
+        while (parent is None or os.getppid() == parent) and not lifecycle.stopping.is_set():
+            free = self.dispatcher.workers - self.dispatcher.pending()
+            try:
+                jobs = self.update_log.claim(owner, free) if free > 0 else []
+            except sqlite3.Error as e:
+                log(f"🛑 [QUEUE ERROR] {e}")
+                jobs = []
+            for upd in jobs:
+                self.dispatcher.submit(self.chat_of(upd), upd)
+            if not jobs: time.sleep(self.queue_poll)
+
+    def handle_queued(self, upd):
+        try:
+            self.handle_update(upd)
+        except Exception:
+            self.update_log.release(upd["update_id"])
+            raise
+        self.update_log.ack(upd["update_id"])
+
+# --- ДИСПЕТЧЕР ОБНОВЛЕНИЙ ---
+def update_age(upd):
+    """Сколько секунд назад пользователь отправил сообщение (по date от Telegram)"""
+    msg = upd.get("message") or {}
+    return time.time() - msg["date"] if "date" in msg else 0.0
+
+class FairQueue:
+    """Честная очередь (SCFQ): задача получает тег = max(виртуальное время, тег прошлой задачи чата) + цена,
+    первой идёт задача с меньшим тегом. Тяжёлый чат уходит вперёд по тегам и не душит остальных,
+    дешёвый текст обгоняет фото. Общая полоса (ключи бота) ограничена слотами, своя (BYOK) — нет."""
+    def __init__(self, shared_slots):
+        self.shared_slots = shared_slots
+        self.shared_busy = 0
+        self.vtime = 0.0
+        self.tags = {}               # chat_id -> тег последней задачи чата
+        self.lanes = {False: [], True: []}   # общая полоса? -> куча (тег, №, задача)
+        self.seq = 0
+
+    def push(self, chat_id, item, cost, shared):
+        tag = max(self.vtime, self.tags.get(chat_id, 0.0)) + cost
+        self.tags[chat_id] = tag
+        self.seq += 1
+        heapq.heappush(self.lanes[shared], (tag, self.seq, item))
+
+    def pop(self):
+        """(задача, общая полоса?) с наименьшим тегом; None — брать нечего"""
+        best = None
+        for shared, heap in self.lanes.items():
+            if not heap or (shared and self.shared_busy >= self.shared_slots): continue
+            if best is None or heap[0] < self.lanes[best][0]: best = shared
+        if best is None: return None
+        tag, _, item = heapq.heappop(self.lanes[best])
+        self.vtime = max(self.vtime, tag)
+        if best: self.shared_busy += 1
+        if len(self.tags) > 10000:
+            # Теги ниже виртуального времени уже ничего не меняют
+            self.tags = {c: t for c, t in self.tags.items() if t > self.vtime}
+        return item, best
+
+    def done(self, shared):
+        if shared: self.shared_busy -= 1
+
+    def waiting(self):
+        return sum(len(h) for h in self.lanes.values())
+
+class Dispatcher:
+    """Пул воркеров: разные чаты параллельно, один чат — строго по порядку.
+    Очередной чат выбирает FairQueue; classify(upd) -> (цена, через общие ключи?)."""
+    def __init__(self, handler, workers=8, max_pending=200, classify=None, on_drop=None,
+                 shared_slots=None, per_chat=10, deadline=0):
+        self.handler = handler
+        self.workers = workers
+        self.classify = classify or (lambda upd: (1, True))
+        self.on_drop = on_drop or (lambda upd, reason: None)
+        self.per_chat = per_chat     # больше апдейтов от одного чата в очереди не держим
+        self.deadline = deadline     # задачу старше стольких секунд не решаем (0 — без срока)
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.chats = {}              # chat_id -> очередь его апдейтов [(апдейт, цена, общая полоса?)]
+        self.fair = FairQueue(shared_slots or workers)
+        self.in_flight = set()       # update_id, принятые, но ещё не обработанные
+        self.slots = BoundedSemaphore(max_pending)
+        for _ in range(workers):
+            Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, chat_id, upd):
+        with self.lock:
+            q = self.chats.get(chat_id)
+            flood = q is not None and len(q) >= self.per_chat
+        if flood:
+            self.on_drop(upd, "busy")
+            return False
+        # Цена и полоса — до блокировки: classify читает SQLite (ключи, состояние чата),
+        # под self.lock это остановило бы всех воркеров и поллер
+        item = (upd, *self.classify(upd))
+        # Блокируемся, если очередь переполнена: поллер не тянет апдейты впрок
+        self.slots.acquire()
+        with self.lock:
+            self.in_flight.add(upd["update_id"])
+            q = self.chats.get(chat_id)
+            if q is None:
+                self.chats[chat_id] = deque([item])
+                self._ready(chat_id, item)
+            else:
+                q.append(item)
+        return True
+
+    def _ready(self, chat_id, item):
+        _, cost, shared = item
+        self.fair.push(chat_id, (chat_id, cost), cost, shared)
+        self.cond.notify()
+
+    def _worker(self):
         while True:
+            with self.lock:
+                while (picked := self.fair.pop()) is None:
+                    self.cond.wait()
+                (chat_id, cost), shared = picked
+                upd = self.chats[chat_id][0][0]
+            t = time.perf_counter()
             try:
-                res = self.session.get(self.tg_url + "getUpdates", params={"offset": self.offset, "timeout": 20}).json()
-                for upd in res.get("result", []):
-                    self.offset = upd["update_id"] + 1
-                    
-                    # 1. ОБРАБОТКА КНОПОК
-                    if "callback_query" in upd:
-                        cq = upd["callback_query"]
-                        uid = cq["message"]["chat"]["id"]
-                        self.session.post(self.tg_url + "answerCallbackQuery", json={"callback_query_id": cq["id"]})
-                        
-                        if cq["data"] == "tutorial":
-                            t_msg = ("🔑 **ИНСТРУКЦИЯ ПО КЛЮЧУ**\n\n"
-                                     "1. Зайди на [Google AI Studio](https://aistudio.google.com/app/apikey)\n"
-                                     "2. Нажми **'Create API key'**\n"
-                                     "3. Пришли скопированный ключ мне (начинается на AIza).\n\n"
-                                     "Это даст тебе **полный безлимит**!")
-                            self.send_smart_message(uid, t_msg, with_kb=False)
+                with tracing(upd, chat_id):
+                    try:
+                        if self.deadline and cost >= 1 and update_age(upd) > self.deadline:
+                            self.on_drop(upd, "stale")
                         else:
-                            log(f"🔘 Кнопка: {cq['data']} от {uid}")
-                            new_ans = self.call_gemini_ai("Переработай ответ в этом режиме", user_id=uid, sub_mode=cq["data"])
-                            self.send_smart_message(uid, "🔄 **ОБНОВЛЕННОЕ РЕШЕНИЕ:**\n\n" + new_ans)
-                        continue
+                            self.handler(upd)
+                        metrics.inc("tggb_updates_total", result="ok")
+                    except Exception as e:
+                        metrics.inc("tggb_updates_total", result="error")
+                        log(f"🛑 [WORKER ERROR] {e}")
+            finally:
+                metrics.observe("tggb_update_seconds", time.perf_counter() - t)
+                with self.lock:
+                    self.fair.done(shared)
+                    q = self.chats[chat_id]
+                    q.popleft()
+                    self.in_flight.discard(upd["update_id"])
+                    # Следующий апдейт чата снова встаёт в честную очередь со своим тегом
+                    if q: self._ready(chat_id, q[0])
+                    else: del self.chats[chat_id]
+                    self.cond.notify_all()
+                self.slots.release()
 
-                    msg = upd.get("message")
-                    if not msg or "chat" not in msg: continue
-                    chat_id = msg["chat"]["id"]
-                    u_text = msg.get("text", "")
-
-                    # 2. ПРИВЕТСТВИЕ (Идея №2)
-                    if u_text == "/start":
-                        welcome = ("👋 **Привет! Я твой элитный ГДЗ-бот 2026.**\n\n"
-                                   "📸 Просто пришли мне **фото задачи** или напиши её текстом.\n\n"
-                                   "✨ Я умею:\n"
-                                   "• Решать математику, физику, химию\n"
-                                   "• Разбирать рукописный почерк\n"
-                                   "• Объяснять сложные темы\n"
-                                   "• Давать советы для ЕГЭ")
-                        self.send_smart_message(chat_id, welcome, with_kb=False)
-                        continue
+    def pending(self):
+        with self.lock:
+            return len(self.in_flight)
 
-                    # 3. ПРИЕМ ЛИЧНОГО КЛЮЧА
-                    if u_text.strip().startswith("AIza"):
-                        user_keys[chat_id] = u_text.strip()
-                        log(f"🔑 Пользователь {chat_id} добавил свой ключ.")
-                        self.send_smart_message(chat_id, "✅ **Ключ принят!** Теперь для тебя действуют твои персональные лимиты.", with_kb=False)
-                        continue
+# --- ОЧЕРЕДЬ ОТПРАВКИ ---
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
 
-                    # 4. ОБРАБОТКА ФОТО (Идея №10 - сжатие)
-                    img_data = None
-                    if "photo" in msg:
-                        log(f"📸 Фото от {chat_id}")
-                        fid = msg["photo"][-1]["file_id"]
-                        fpath = self.session.get(self.tg_url + "getFile", params={"file_id": fid}).json()["result"]["file_path"]
-                        raw_img = self.session.get(f"https://api.telegram.org/file/bot{self.tg_token}/{fpath}").content
-                        
-                        img = Image.open(io.BytesIO(raw_img)).convert('RGB')
-                        img.thumbnail((1600, 1600))
-                        buf = io.BytesIO()
-                        img.save(buf, format="JPEG", quality=85)
-                        img_data = buf.getvalue()
-
-                    # 5. ГЕНЕРАЦИЯ ОТВЕТА
-                    prompt = msg.get("text", msg.get("caption", "Реши задачу на фото"))
-                    self.session.post(self.tg_url + "sendChatAction", json={"chat_id": chat_id, "action": "typing"})
-                    
-                    ans = self.call_gemini_ai(prompt, img_data, user_id=chat_id)
-
-                    # 6. ВЫХОД ПРИ ЗАКОНЧИВШИХСЯ ЛИМИТАХ
-                    if ans == "LIMIT_ERROR":
-                        l_msg = ("⚠️ **Лимиты бота исчерпаны!**\n\n"
-                                 "Сегодня было слишком много задач. Чтобы продолжить прямо сейчас, "
-                                 "добавь **свой личный ключ** (это бесплатно). Нажми кнопку ниже для инструкции.")
-                        self.send_smart_message(chat_id, l_msg, with_kb=True)
-                    elif ans == "ERROR":
-                        self.send_smart_message(chat_id, "❌ Ошибка. Попробуй другое фото.", with_kb=False)
-                    else:
-                        self.send_smart_message(chat_id, ans)
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """0, если токен есть; иначе сколько секунд ждать"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class SendQueue:
+    """Исходящие вызовы Bot API: очередь на чат, лимиты на чат и общий, учёт retry_after"""
+    def __init__(self, tg_url, per_chat_rate=1.0, per_chat_burst=3, global_rate=25.0):
+        self.tg_url = tg_url
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.cond = Condition()
+        self.chats = {}              # chat_id -> deque([method, body, future, попытки, trace апдейта])
+        self.buckets = {}            # chat_id -> TokenBucket
+        self.paused = {}             # chat_id -> monotonic, до которого ждём (retry_after)
+        self.busy = set()            # в каждом чате в полёте не больше одного вызова — порядок сохраняется
+        self.last_action = {}        # chat_id -> когда слали sendChatAction
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.notify = self._notify_threads
+
+    def submit(self, chat_id, method, body):
+        fut = Future()
+        with self.cond:
+            self.chats.setdefault(chat_id, deque()).append([method, body, fut, 0, trace_var.get()])
+        self.notify()
+        return fut
+
+    def chat_action(self, chat_id, action="typing"):
+        """«Печатает...» держится ~5 с, поэтому повторы в этом окне и дубли в очереди схлопываем"""
+        now = time.monotonic()
+        with self.cond:
+            q = self.chats.get(chat_id, ())
+            if now - self.last_action.get(chat_id, 0) < 4 or any(j[0] == "sendChatAction" for j in q):
+                return
+            self.last_action[chat_id] = now
+        self.submit(chat_id, "sendChatAction", {"chat_id": chat_id, "action": action})
+
+    def pending(self):
+        with self.cond:
+            return sum(len(q) for q in self.chats.values())
+
+    def _take(self):
+        """(chat_id, задание) или (None, сколько ждать); вызывать под self.cond"""
+        now = time.monotonic()
+        wait = None
+        for chat_id, q in self.chats.items():
+            if chat_id in self.busy or not q: continue
+            delay = self.paused.get(chat_id, 0) - now
+            if delay <= 0 and q[0][0] != "sendChatAction":
+                bucket = self.buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+                delay = bucket.wait_time(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            g = self.global_bucket.wait_time(now)
+            if g > 0: return None, g
+            self.global_bucket.tokens -= 1
+            if q[0][0] != "sendChatAction": self.buckets[chat_id].tokens -= 1
+            self.busy.add(chat_id)
+            return chat_id, q[0]
+        return None, wait
+
+    def _finish(self, chat_id, job, resp=None, error=None):
+        method, body, fut, attempts, trace = job
+        retry = False
+        result = "exception" if error is not None else "ok" if resp.get("ok") else resp.get("error_code", "error")
+        metrics.inc("tggb_telegram_calls_total", method=method, result=result)
+        with self.cond:
+            self.busy.discard(chat_id)
+            if error is not None:
+                # Сетевая ошибка: повторяем только этот кусок, уже отправленные не трогаем
+                retry = attempts < 3
+                if retry: self.paused[chat_id] = time.monotonic() + 2 ** attempts
+            elif resp.get("error_code") == 429:
+                retry = True
+                self.paused[chat_id] = time.monotonic() + resp.get("parameters", {}).get("retry_after", 5)
+            elif not resp.get("ok") and "parse_mode" in body and "parse" in resp.get("description", ""):
+                # Telegram не разобрал Markdown — тот же текст без разметки
+                body.pop("parse_mode")
+                body["text"] = md_plain(body["text"])
+                retry = True
+            if retry:
+                job[3] = attempts + 1
+            else:
+                q = self.chats[chat_id]
+                q.popleft()
+                if not q:
+                    del self.chats[chat_id]
+                    self.paused.pop(chat_id, None)
+                    if len(self.buckets) > 10000: self.buckets.clear()
+                    if len(self.last_action) > 10000: self.last_action.clear()
+        if not retry:
+            if error is not None or not resp.get("ok"):
+                log(f"🛑 [SEND] {method} -> {chat_id}: {error or resp.get('description')}", trace=trace, chat=chat_id)
+            elif method != "sendChatAction":
+                log(f"📤 [SEND] {method} -> {chat_id}", trace=trace, chat=chat_id, attempts=attempts + 1)
+            fut.set_result(resp.get("result") if resp and resp.get("ok") else None)
+        self.notify()
 
+    # Потоковый движок
+    def _notify_threads(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def start_threads(self, net, workers=4):
+        for _ in range(workers):
+            Thread(target=self._thread_worker, args=(net,), daemon=True).start()
+
+    def _thread_worker(self, net):
+        while True:
+            with self.cond:
+                chat_id, job = self._take()
+                while chat_id is None:
+                    self.cond.wait(job)
+                    chat_id, job = self._take()
+            t = time.perf_counter()
+            try:
+                resp = net.post("bot", self.tg_url + job[0], json=job[1]).json()
+                metrics.observe("tggb_telegram_seconds", time.perf_counter() - t, method=job[0])
+                self._finish(chat_id, job, resp)
             except Exception as e:
-                log(f"🛑 [CRITICAL] {e}")
-                time.sleep(5)
+                self._finish(chat_id, job, error=e)
 
-if __name__ == "__main__":
-    Thread(target=run_web, daemon=True).start()
-    UltraMasterBot().run_polling()
-        self.tg_url = f"https://api.telegram.org/bot{self.tg_token}/"
-        self.model_name = "models/gemini-2.0-flash" 
-        self.offset = 0
-        self.session = requests.Session()
-        
-        self.system_instructions = (
-            "Ты — элитный ИИ-репетитор. Твои правила:\n"
-            "1. Решай всё по фото (даже рукописное).\n"
-            "2. Формат: **Дано**, **Решение**, **Ответ**.\n"
-            "3. Режим ЕГЭ: давай советы по оформлению.\n"
-            "4. В конце пиши '🎥 Темы для YouTube: ...'.\n"
-            "5. Используй LaTeX и объясняй логику просто."
-        )
+    # Async-движок
+    def start_tasks(self, net, workers=4):
+        loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.notify = lambda: loop.call_soon_threadsafe(self.event.set)
+        self.tasks = [asyncio.create_task(self._task_worker(net)) for _ in range(workers)]
+
+    async def _task_worker(self, net):
+        while True:
+            with self.cond:
+                chat_id, job = self._take()
+            if chat_id is None:
+                self.event.clear()
+                try:
+                    await asyncio.wait_for(self.event.wait(), job)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            t = time.perf_counter()
+            try:
+                resp = (await net.post("bot", self.tg_url + job[0], json=job[1])).json()
+                metrics.observe("tggb_telegram_seconds", time.perf_counter() - t, method=job[0])
+                self._finish(chat_id, job, resp)
+            except Exception as e:
+                self._finish(chat_id, job, error=e)
 
-    def get_kb(self):
-        """Инлайн-кнопки для меню"""
-        return {
-            "inline_keyboard": [
-                [{"text": "📚 Объясни проще", "callback_data": "mode_simple"}, 
-                 {"text": "📝 Режим ЕГЭ/ОГЭ", "callback_data": "mode_ege"}],
-                [{"text": "🔑 Свой ключ (Инструкция)", "callback_data": "tutorial"}]
-            ]
-        }
+# --- ASYNC-ДВИЖОК ---
+class AsyncUltraGdzBot(UltraGdzBot):
+    """Тот же бот на asyncio + httpx: тысячи запросов к ИИ без потока на каждый"""
+    def setup_io(self):
+        self.max_in_flight = int(os.environ.get("MAX_IN_FLIGHT", 1000))
+        # Клиенты и диспетчер создаются в open_io(), уже внутри event loop
+        self.net = None
+        self.dispatcher = None
 
-    def call_ai(self, text, img_bytes=None, user_id=None, sub_mode="standard"):
-        """Запрос к нейросети с учетом личных ключей"""
-        # Проверка: есть ли у юзера свой ключ, если нет - берем админский
-        active_key = user_keys.get(user_id, self.admin_key)
-        
-        instruction = self.system_instructions
-        if sub_mode == "mode_simple": instruction += "\nУпрости объяснение."
-        elif sub_mode == "mode_ege": instruction += "\nОформи по критериям ЕГЭ."
-
-        parts = [{"text": f"{instruction}\n\nЗАДАЧА: {text}"}]
-        if img_bytes:
-            log(f"🖼 [AI] Обработка фото для {user_id}")
-            parts.append({"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(img_bytes).decode()}})
-        
-        payload = {"contents": [{"parts": parts}], "generationConfig": {"temperature": 0.35}}
-        api_url = f"https://generativelanguage.googleapis.com/v1/{self.model_name}:generateContent?key={active_key}"
+    async def drop_update(self, upd, reason):
+        """Снятие апдейта (async): ack в SQLite — в потоке, не в event loop"""
+        self.note_drop(upd, reason)
+        if self.update_log: await asyncio.to_thread(self.update_log.ack, upd["update_id"])
+
+    async def call_ai(self, text, img_bytes=None, user_id=None, sub_mode="standard"):
+        """Запрос к ИИ с поддержкой BYOK (async)"""
+        key, cached = await self.cache_lookup(text, sub_mode, img_bytes)
+        if cached is not None:
+            return cached
+        own_key = await asyncio.to_thread(user_keys.get, user_id)
+        ans, leader = await self.flights.do_async(
+            flight_key(text, sub_mode, img_bytes), lambda: self.ask_gemini(self.build_ai_request(text, img_bytes, sub_mode), own_key),
+            own_key)
+        if leader and ans not in ("ERROR", "LIMIT_ERROR"): await asyncio.to_thread(self.cache.put, key, ans)
+        return ans
+
+    async def cache_lookup(self, text, sub_mode, img_bytes):
+        """Ключ (sha1 страниц) и чтение кэша с диска — в потоке, не в event loop"""
+        def lookup():
+            key = self.cache.key(self.model_name, text, sub_mode, img_bytes)
+            return key, self.cache.get(key)
+        return await asyncio.to_thread(lookup)
+
+    async def ask_gemini(self, req, own_key=None, post=None):
+        """Дешёвая модель с повтором на основной, если ответ не прошёл проверку (async)"""
+        ans = await self.ask_pool(req, own_key, post)
+        if not req.model or ans == "LIMIT_ERROR" or self.router.accept(ans): return ans
+        metrics.inc("tggb_route_escalations_total", reason=req.route)
+        req.model = None
+        req.escalated = True
+        return await self.ask_pool(req, own_key, post)
+
+    async def ask_pool(self, req, own_key=None, post=None):
+        """Личный ключ или ключ из пула с повтором на другом после 429 (async)"""
+        post = post or self.post_hedged
+        if own_key:
+            return await post(own_key, req)
+        tried = self.usable_keys()
+        if tried is None: return "ERROR"
+        for _ in range(2):
+            api_key, wait = self.key_pool.acquire(exclude=tried)
+            if not api_key: break
+            tried.add(api_key)
+            if wait: await asyncio.sleep(wait)
+            ans = await post(api_key, req)
+            if ans != "LIMIT_ERROR": return ans
+        return "LIMIT_ERROR"
 
+    async def image_uri(self, api_key, req):
+        if not self.file_handles.wanted(req): return None
+        uri = self.file_handles.get(api_key, req.digest)
+        if uri:
+            metrics.inc("tggb_gemini_uploads_total", result="reused")
+            return uri
+        t = time.perf_counter()
         try:
-            r = self.session.post(api_url, json=payload, timeout=90)
-            if r.status_code == 429:
-                log(f"⏳ [LIMIT] Лимит исчерпан для {user_id}")
-                return "LIMIT_ERROR"
-            if r.status_code != 200:
-                log(f"❌ [AI ERROR] {r.text}")
-                return "ERROR"
-            return r.json()['candidates'][0]['content']['parts'][0]['text']
+            r = await self.net.post("ai", self.upload_url(api_key), content=req.img, headers=UPLOAD_HEADERS)
+            uri = r.json()["file"]["uri"]
         except Exception as e:
-            log(f"🛑 [CRIT] {e}")
-            return "ERROR"
-
-    def send_final(self, chat_id, text, use_kb=True):
-        """Отправка с разбивкой длинных текстов"""
-        limit = 3800
-        parts = [text[i:i + limit] for i in range(0, len(text), limit)]
-        for i, part in enumerate(parts):
-            is_last = (i == len(parts) - 1)
-            payload = {
-                "chat_id": chat_id,
-                "text": part,
-                "parse_mode": "Markdown",
-                "reply_markup": self.get_kb() if (is_last and use_kb) else None
-            }
-            self.session.post(self.tg_url + "sendMessage", json=payload)
+            metrics.inc("tggb_gemini_uploads_total", result="error")
+            log(f"🛑 [FILES] Загрузка картинки не удалась: {e}")
+            return None
+        metrics.observe("tggb_gemini_upload_seconds", time.perf_counter() - t)
+        metrics.inc("tggb_gemini_uploads_total", result="ok")
+        self.file_handles.put(api_key, req.digest, uri)
+        return uri
 
-    def run(self):
-        log("🛰 [SYS] Бот в эфире...")
-        while True:
+    async def context_name(self, api_key, req):
+        known, name = self.context_known(api_key, req)
+        if known: return name
+        try:
+            r = await self.net.post("ai", f"{GEMINI_API}/v1beta/cachedContents?key={api_key}", json=self.context_body())
+        except Exception as e:
+            log(f"🛑 [CONTEXT] {e}")
+            return None
+        return self.context_saved(api_key, r)
+
+    async def post_hedged(self, api_key, req):
+        """Основная модель и дубль в запасную после p95 (async): проигравший запрос отменяется"""
+        model = self.live_model(req)
+        if not model: return "ERROR"
+        fallback = self.fallback_for(req)
+        if model != self.model_name or not fallback: return await self.post_ai(api_key, req, model)
+        first = asyncio.ensure_future(self.post_ai(api_key, req, model))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_budget(model))
+            if done or not self.breakers.allow("model", fallback): return await first
+            metrics.inc("tggb_gemini_hedges_total")
+            second = asyncio.ensure_future(self.post_ai(api_key, req, fallback))
+            pending, ans = {first, second}, "ERROR"
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    ans = task.result()
+                    if ans not in ("ERROR", "LIMIT_ERROR"):
+                        metrics.inc("tggb_gemini_hedge_wins_total", model="fallback" if task is second else "primary")
+                        return ans
+            return ans
+        finally:
+            for task in pending: task.cancel()
+
+    async def post_ai(self, api_key, req, model=None):
+        model = model or self.model_name
+        uri = await self.image_uri(api_key, req)
+        ctx = await self.context_name(api_key, req) if model == self.model_name else None
+        for attempt in range(self.ai_retries + 1):
+            if attempt:
+                if not self.breakers.allow("model", model): break
+                metrics.inc("tggb_gemini_retries_total")
+                await asyncio.sleep(backoff_delay(attempt))
+            t = time.perf_counter()
             try:
-                r = self.session.get(self.tg_url + "getUpdates", params={"offset": self.offset, "timeout": 20}).json()
-                for upd in r.get("result", []):
-                    self.offset = upd["update_id"] + 1
-                    
-                    # Обработка кнопок
-                    if "callback_query" in upd:
-                        cb = upd["callback_query"]
-                        chat_id = cb["message"]["chat"]["id"]
-                        self.session.post(self.tg_url + "answerCallbackQuery", json={"callback_query_id": cb["id"]})
-                        
-                        if cb["data"] == "tutorial":
-                            msg = ("🔑 **КАК ДОБАВИТЬ СВОЙ КЛЮЧ?**\n\n"
-                                   "1. Зайди на [Google AI Studio](https://aistudio.google.com/app/apikey)\n"
-                                   "2. Нажми **'Create API key'**\n"
-                                   "3. Скопируй его (начинается на AIza...)\n"
-                                   "4. Просто **пришли его мне в чат** сообщением.\n\n"
-                                   "Это бесплатно и снимет все лимиты!")
-                            self.send_final(chat_id, msg, use_kb=False)
-                        else:
-                            log(f"🔘 [BTN] Режим {cb['data']} для {chat_id}")
-                            res = self.call_ai("Обнови решение", user_id=chat_id, sub_mode=cb["data"])
-                            self.send_final(chat_id, "🔄 **РЕЗУЛЬТАТ ОБРАБОТКИ:**\n\n" + res)
-                        continue
+                r = await self.net.post("ai", self.ai_url(api_key, ctx, model), content=req.body(uri, ctx),
+                                        headers=JSON_HEADERS)
+            except httpx.HTTPError as e:
+                self.ai_outcome(api_key, model, "exception", time.perf_counter() - t)
+                log(f"⚠️ [AI] {model}: {type(e).__name__}")
+                if transient_error(e): continue
+                return "ERROR"
+            self.ai_outcome(api_key, model, r.status_code, time.perf_counter() - t)
+            if r.status_code in TRANSIENT: continue
+            if self.stale_refs(api_key, req, uri, ctx, r.status_code): return await self.post_ai(api_key, req, model)
+            self.key_pool.report(api_key, r.status_code, retry_after_of(r) if r.status_code == 429 else None)
+            try:
+                return self.parse_ai_answer(r, model)
+            except (ValueError, KeyError, IndexError):
+                return "ERROR"
+        return "ERROR"
 
-                    msg = upd.get("message")
-                    if not msg or "chat" not in msg: continue
-                    chat_id = msg["chat"]["id"]
-                    text = msg.get("text", "")
+    async def solve_streaming(self, chat_id, text, img_bytes=None, user_id=None, sub_mode="standard"):
+        """Ответ ИИ по мере генерации (async)"""
+        key, cached = await self.cache_lookup(text, sub_mode, img_bytes)
+        if cached is not None:
+            await self.send_smart_msg(chat_id, cached)
+            return cached
+        own_key = await asyncio.to_thread(user_keys.get, user_id)
 
-                    # Если пользователь прислал API-ключ
-                    if text.strip().startswith("AIza"):
-                        user_keys[chat_id] = text.strip()
-                        log(f"🔑 [KEY] Пользователь {chat_id} добавил свой ключ.")
-                        self.send_final(chat_id, "✅ **Ключ успешно подключен!** Теперь ты на безлимите.", use_kb=False)
-                        continue
+        async def stream():
+            reply = StreamReply(chat_id, interval=self.stream_interval)
+            await self.apply_stream_ops(reply, reply.ops(""))
 
-                    if text == "/start":
-                        self.send_final(chat_id, "📚 Привет! Пришли фото задачи. Если лимиты закончатся, ты сможешь добавить свой ключ.", use_kb=False)
+            async def on_text(so_far):
+                await self.apply_stream_ops(reply, reply.ops(so_far))
+
+            async def post(api_key, r):
+                return await self.post_ai_stream(api_key, r, on_text)
+
+            req = self.build_ai_request(text, img_bytes, sub_mode)
+            ans = await self.ask_gemini(req, own_key, post=post)
+            if ans in ("ERROR", "LIMIT_ERROR"):
+                await self.apply_stream_ops(reply, reply.abort_ops())
+                return ans
+            await self.apply_stream_ops(reply, reply.ops(ans, final=True, keyboard=self.get_keyboard()))
+            await asyncio.to_thread(self.cache.put, key, ans)
+            return ans
+
+        ans, leader = await self.flights.do_async(flight_key(text, sub_mode, img_bytes), stream, own_key)
+        if not leader and ans not in ("ERROR", "LIMIT_ERROR"): await self.send_smart_msg(chat_id, ans)
+        return ans
+
+    async def post_ai_stream(self, api_key, req, on_text):
+        model = self.live_model(req)
+        if not model: return "ERROR"
+        uri = await self.image_uri(api_key, req)
+        ctx = await self.context_name(api_key, req) if model == self.model_name else None
+        for attempt in range(self.ai_retries + 1):
+            if attempt:
+                if not self.breakers.allow("model", model): break
+                metrics.inc("tggb_gemini_retries_total", stream=1)
+                await asyncio.sleep(backoff_delay(attempt))
+            chunks, usage = [], None
+            t = time.perf_counter()
+            try:
+                async with self.net.stream("ai", "POST", self.ai_stream_url(api_key, ctx, model), content=req.body(uri, ctx),
+                                           headers=JSON_HEADERS) as r:
+                    self.ai_outcome(api_key, model, r.status_code, 0, stream=True)
+                    if r.status_code in TRANSIENT or self.stale_refs(api_key, req, uri, ctx, r.status_code):
+                        await r.aread()
+                        if r.status_code in TRANSIENT: continue
+                        return await self.post_ai_stream(api_key, req, on_text)
+                    if r.status_code == 429:
+                        await r.aread()
+                        self.key_pool.report(api_key, 429, retry_after_of(r))
+                        return "LIMIT_ERROR"
+                    self.key_pool.report(api_key, r.status_code)
+                    if r.status_code != 200: return "ERROR"
+                    async for line in r.aiter_lines():
+                        piece, event_usage = parse_sse_chunk(line)
+                        usage = event_usage or usage
+                        if piece:
+                            if not chunks:
+                                metrics.observe("tggb_gemini_first_chunk_seconds", time.perf_counter() - t,
+                                                model=model.rsplit("/", 1)[-1])
+                            chunks.append(piece)
+                            await on_text("".join(chunks))
+            except httpx.HTTPError as e:
+                self.ai_outcome(api_key, model, "exception", 0, stream=True)
+                log(f"⚠️ [AI] {model}: {type(e).__name__}")
+                if not chunks and transient_error(e): continue
+                return "ERROR"
+            except Exception as e:
+                log(f"🛑 [AI] Поток ответа прерван: {e}")
+                return "ERROR"
+            metrics.observe("tggb_gemini_seconds", time.perf_counter() - t, model=model.rsplit("/", 1)[-1], stream=1)
+            record_usage(model, usage)
+            return "".join(chunks) or "ERROR"
+        return "ERROR"
+
+    async def apply_stream_ops(self, reply, ops):
+        futures = [(i, body, self.sender.submit(reply.chat_id, method, body)) for method, i, body in ops]
+        for i, body, fut in futures:
+            result = await asyncio.wrap_future(fut)
+            if result is not None: reply.done(i, body, result)
+
+    async def send_smart_msg(self, chat_id, text, with_kb=True):
+        """Деление длинных сообщений и постановка в очередь отправки (async)"""
+        for payload in self.build_messages(chat_id, text, with_kb):
+            self.sender.submit(chat_id, "sendMessage", payload)
+
+    async def handle_update(self, upd):
+        """Обработка одного апдейта (async)"""
+        if "callback_query" in upd:
+            cb = upd["callback_query"]
+            uid = cb["message"]["chat"]["id"]
+            await self.net.post("bot", self.tg_url + "answerCallbackQuery", json={"callback_query_id": cb["id"]})
+
+            if cb["data"] == "tutorial":
+                await self.send_smart_msg(uid, TUTORIAL_TEXT, with_kb=False)
+            else:
+                st = await asyncio.to_thread(self.states.get, uid)
+                if not st:
+                    await self.send_smart_msg(uid, NO_TASK_TEXT, with_kb=False)
+                    return
+                res = await self.call_ai(st.prompt, st.img_data, user_id=uid, sub_mode=cb["data"])
+                await self.send_smart_msg(uid, "🔄 **ОБНОВЛЕНИЕ:**\n\n" + res)
+            return
+
+        msg = upd.get("message")
+        if not msg: return
+        chat_id = msg["chat"]["id"]
+        text = msg.get("text", "")
+
+        if text == "/start":
+            await self.send_smart_msg(chat_id, WELCOME_TEXT, with_kb=False)
+            return
+
+        if text.strip().startswith("AIza"):
+            await asyncio.to_thread(user_keys.__setitem__, chat_id, text.strip())
+            await self.send_smart_msg(chat_id, KEY_OK_TEXT, with_kb=False)
+            return
+
+        timer = StageTimer()
+        img_data = None
+        photos = msg.get("photos") or ([msg["photo"]] if "photo" in msg else [])
+        if photos:
+            log(f"📸 Фото от {chat_id}" + (f" (альбом, {len(photos)} шт.)" if len(photos) > 1 else ""),
+                chat=chat_id, pages=len(photos))
+            img_data = await self.fetch_photo(photos, timer)
+
+        prompt = msg.get("text", msg.get("caption", "Реши задачу"))
+        self.sender.chat_action(chat_id)
+
+        if self.streaming:
+            ans = await self.solve_streaming(chat_id, prompt, img_data, user_id=chat_id)
+        else:
+            ans = await self.call_ai(prompt, img_data, user_id=chat_id)
+        timer.lap("ai")
+
+        if ans == "LIMIT_ERROR":
+            await self.send_smart_msg(chat_id, LIMIT_TEXT, with_kb=True)
+        elif ans == "ERROR":
+            await self.send_smart_msg(chat_id, ERROR_TEXT, with_kb=False)
+        else:
+            await asyncio.to_thread(self.states.put, chat_id, prompt, img_data, ans)
+            if not self.streaming: await self.send_smart_msg(chat_id, ans)
+        timer.lap("send")
+        log(f"⏱ [TIMING] {chat_id}: {timer.summary()}", chat=chat_id, stages=timer.fields())
+
+    async def fetch_photo(self, photos, timer):
+        """Снимок задачи; страницы альбома — параллельно (async)"""
+        if len(photos) == 1: return await self.fetch_page(photos[0], timer)
+        pages = tuple(await asyncio.gather(*(self.fetch_page(sizes) for sizes in photos)))
+        timer.lap("album", sum(map(len, pages)))
+        return pages
+
+    async def fetch_page(self, sizes, timer=None):
+        """getFile -> скачивание -> сжатие (async)"""
+        photo = pick_photo(sizes)
+        f_info = (await self.net.get("bot", self.tg_url + "getFile", params={"file_id": photo["file_id"]})).json()
+        if timer: timer.lap("getFile")
+        raw = (await self.net.get("files", f"{TELEGRAM_API}/file/bot{self.tg_token}/{f_info['result']['file_path']}")).content
+        if timer: timer.lap("download", len(raw))
+        if image_ready(raw):
+            img_data = raw
+        else:
+            # Pillow грузит CPU — уводим из event loop (в пул процессов, если он есть)
+            img_data = await asyncio.get_running_loop().run_in_executor(self.image_pool, prepare_image, raw)
+        if timer: timer.lap("image", len(img_data))
+        return img_data
+
+    def open_io(self):
+        """Пулы соединений и диспетчер (нужен уже запущенный event loop)"""
+        conns = min(self.max_in_flight, 100)
+        # К Gemini — по соединению на запрос в полёте, если сервер не согласился на HTTP/2
+        self.net = AsyncHttpPools(pool_specs(bot=conns, files=conns, ai=self.max_in_flight),
+                                  http2=("bot", "files", "ai") if HTTP2 else ())
+        self.dispatcher = AsyncDispatcher(self.handle_update, max_in_flight=self.max_in_flight, classify=self.classify,
+                                          on_drop=self.drop_update, **self.fair_params(50))
+        self.sender = SendQueue(self.tg_url, global_rate=float(os.environ.get("SEND_RATE", 25)))
+        self.sender.start_tasks(self.net, workers=int(os.environ.get("SEND_WORKERS", 4)))
+
+    async def warm(self):
+        """Прогрев соединений и пула картинок (см. UltraGdzBot.warm)"""
+        t = time.perf_counter()
+        calls = self.warm_calls()
+        aws = [self.net.get(pool, url, timeout=10) for pool, url in calls]
+        if self.image_warm: aws.append(asyncio.wrap_future(self.image_warm))
+        Image.init()
+        results = await asyncio.gather(*aws, return_exceptions=True)
+        self.warm_done([pool for pool, _ in calls] + ["images"] * bool(self.image_warm), results, t)
+        versions = {r.http_version for r in results if isinstance(r, httpx.Response)}
+        log(f"🔌 [SYS] Протоколы: {', '.join(sorted(versions)) or '—'} (HTTP/2 {'вкл' if HTTP2 else 'выкл'})")
+
+    async def run(self):
+        self.open_io()
+        lifecycle.install_async()
+        log(f"🛰 [SYS] Async-бот запущен и слушает... (в полёте до {self.max_in_flight})")
+        async with self.net:
+            await self.warm()
+            await self.delete_webhook()
+            if self.update_log:
+                self.offset = await asyncio.to_thread(self.update_log.offset)
+                self.queue_task = asyncio.create_task(self.consume_queue())
+            self.album_task = asyncio.create_task(self.flush_albums())
+            lifecycle.mark_ready("long polling")
+            while not lifecycle.stopping.is_set():
+                try:
+                    # SIGTERM отменяет long poll, не дожидаясь его таймаута
+                    r = await lifecycle.wait_async(self.net.get("poll", self.tg_url + "getUpdates",
+                                                                params={"offset": self.offset, "timeout": LONG_POLL}))
+                    batch = self.updates_of(r.json())
+                    ready = self.albums.hold(batch)
+                    if self.update_log and batch:
+                        if ready: await asyncio.to_thread(self.update_log.append, ready, self.chat_of)
+                        self.offset = batch[-1]["update_id"] + 1
                         continue
+                    for upd in ready:
+                        await self.dispatcher.submit(self.chat_of(upd), upd)
+                        self.offset = upd["update_id"] + 1
+                    if batch: self.offset = batch[-1]["update_id"] + 1
 
-                    img_data = None
-                    if "photo" in msg:
-                        log(f"📸 [FILE] Загрузка фото от {chat_id}")
-                        f_id = msg["photo"][-1]["file_id"]
-                        f_info = self.session.get(self.tg_url + "getFile", params={"file_id": f_id}).json()
-                        raw = self.session.get(f"https://api.telegram.org/file/bot{self.tg_token}/{f_info['result']['file_path']}").content
-                        img = Image.open(io.BytesIO(raw)).convert('RGB')
-                        img.thumbnail((1600, 1600))
-                        buf = io.BytesIO()
-                        img.save(buf, format="JPEG", quality=85)
-                        img_data = buf.getvalue()
-
-                    prmpt = msg.get("text", msg.get("caption", "Реши задачу"))
-                    self.session.post(self.tg_url + "sendChatAction", json={"chat_id": chat_id, "action": "typing"})
-                    
-                    ans = self.call_ai(prmpt, img_data, user_id=chat_id)
-
-                    if ans == "LIMIT_ERROR":
-                        err = ("⚠️ **Общие лимиты бота исчерпаны!**\n\n"
-                               "Чтобы продолжить прямо сейчас, добавь свой личный ключ по кнопке ниже.")
-                        self.send_final(chat_id, err, use_kb=True)
-                    elif ans == "ERROR":
-                        self.send_final(chat_id, "❌ Произошла ошибка. Попробуй еще раз.", use_kb=False)
-                    else:
-                        self.send_final(chat_id, ans)
+                except asyncio.CancelledError:
+                    if not lifecycle.stopping.is_set(): raise
+                except Exception as e:
+                    log(f"🛑 [LOOP ERROR] {e}")
+                    try:
+                        await lifecycle.wait_async(asyncio.sleep(5))
+                    except asyncio.CancelledError:
+                        if not lifecycle.stopping.is_set(): raise
+            await self.shutdown()
+            await self.confirm_offset()
 
+    async def delete_webhook(self):
+        try:
+            r = (await self.net.post("bot", self.tg_url + "deleteWebhook")).json()
+            log(f"🪝 [SYS] deleteWebhook: {r.get('description', r.get('ok'))}")
+        except Exception as e:
+            log(f"🛑 [WEBHOOK ERROR] deleteWebhook: {e}")
+
+    async def confirm_offset(self):
+        offset = self.offset
+        try:
+            await self.net.get("poll", self.tg_url + "getUpdates", params={"offset": offset, "timeout": 0, "limit": 1})
+            log(f"💾 [SYS] Offset {offset} подтверждён")
+        except Exception as e:
+            log(f"🛑 [SHUTDOWN ERROR] offset {offset}: {e}")
+
+    async def run_webhook(self):
+        """Приём апдейтов через POST /webhook (async)"""
+        self.open_io()
+        lifecycle.install_async()
+        async with self.net:
+            await self.warm()
+            try:
+                r = (await self.net.post("bot", self.tg_url + "setWebhook", json=self.webhook_params())).json()
+                log(f"🪝 [SYS] Async-вебхук {WEBHOOK_URL}: {r.get('description', r.get('ok'))}")
             except Exception as e:
-                log(f"🛑 [LOOP ERR] {e}")
-                time.sleep(5)
+                log(f"🛑 [WEBHOOK ERROR] setWebhook: {e}")
+            if self.update_log: self.queue_task = asyncio.create_task(self.consume_queue())
+            self.album_task = asyncio.create_task(self.flush_albums())
+            lifecycle.mark_ready("webhook")
+            while not lifecycle.stopping.is_set():
+                # Очередь наполняет поток Flask, поэтому ждём её в отдельном потоке (с таймаутом —
+                # иначе при остановке этот поток не даст процессу выйти)
+                try:
+                    upd = await asyncio.to_thread(update_queue.get, True, 1.0)
+                except Empty:
+                    continue
+                try:
+                    for ready in self.albums.hold([upd]): await self.enqueue(ready)
+                    self.offset = max(self.offset, upd["update_id"] + 1)
+                except Exception as e:
+                    log(f"🛑 [WEBHOOK ERROR] {e}")
+            await self.shutdown()
+
+    async def enqueue(self, upd):
+        if self.update_log: await asyncio.to_thread(self.update_log.append, [upd], self.chat_of)
+        else: await self.dispatcher.submit(self.chat_of(upd), upd)
+
+    async def flush_albums(self):
+        while not lifecycle.stopping.is_set():
+            await asyncio.sleep(self.albums.tick)
+            for upd in self.albums.due():
+                try:
+                    await self.enqueue(upd)
+                except Exception as e:
+                    log(f"🛑 [ALBUM ERROR] {e}")
+
+    async def shutdown(self):
+        deadline = time.monotonic() + lifecycle.drain_timeout
+        for upd in self.leftovers():
+            try:
+                await self.enqueue(upd)
+                self.offset = max(self.offset, upd["update_id"] + 1)
+            except Exception as e:
+                log(f"🛑 [SHUTDOWN ERROR] {e}")
+        while (self.dispatcher.pending() or self.sender.pending()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        lifecycle.unfinished = self.dispatcher.pending() + self.sender.pending()
+        if self.update_log:
+            released = await asyncio.to_thread(self.update_log.release_owner, self.queue_owner)
+            if released: log(f"🧵 [QUEUE] Отпущено апдейтов: {released}")
+        if self.image_pool: self.image_pool.shutdown(cancel_futures=True)
+        log(f"👋 [SYS] Остановка: не доделано задач {lifecycle.unfinished}")
+
+    async def run_worker(self, parent=None):
+        """Отдельный процесс-воркер общей очереди (без приёма апдейтов)"""
+        self.open_io()
+        lifecycle.install_async()
+        async with self.net:
+            await self.warm()
+            await self.consume_queue(parent)
+            await self.shutdown()
+
+    async def consume_queue(self, parent=None):
+        owner = self.queue_owner
+        self.dispatcher.handler = self.handle_queued
+        log(f"🧵 [QUEUE] Async-воркер {owner} разбирает {self.update_log.path}")
+        while (parent is None or os.getppid() == parent) and not lifecycle.stopping.is_set():
+            free = min(self.max_in_flight - self.dispatcher.pending(), 100)
+            try:
+                jobs = await asyncio.to_thread(self.update_log.claim, owner, free) if free > 0 else []
+            except sqlite3.Error as e:
+                log(f"🛑 [QUEUE ERROR] {e}")
+                jobs = []
+            for upd in jobs:
+                await self.dispatcher.submit(self.chat_of(upd), upd)
+            if not jobs: await asyncio.sleep(self.queue_poll)
+
+    async def handle_queued(self, upd):
+        try:
+            await self.handle_update(upd)
+        except Exception:
+            await asyncio.to_thread(self.update_log.release, upd["update_id"])
+            raise
+        await asyncio.to_thread(self.update_log.ack, upd["update_id"])
+
+class AsyncDispatcher:
+    """Async-аналог Dispatcher: по задаче на активный чат, общий лимит в полёте.
+    Задачи общей полосы ждут слот в FairQueue, своя полоса (BYOK, команды) идёт сразу."""
+    def __init__(self, handler, max_in_flight=1000, classify=None, on_drop=None,
+                 shared_slots=50, per_chat=10, deadline=0):
+        self.handler = handler
+        self.classify = classify or (lambda upd: (1, True))
+        self.on_drop = on_drop or self.ignore_drop   # корутина: снятие может писать в SQLite через to_thread
+        self.per_chat = per_chat
+        self.deadline = deadline
+        self.fair = FairQueue(shared_slots)
+        self.chats = {}              # chat_id -> очередь его апдейтов
+        self.in_flight = set()
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.tasks = set()           # держим ссылки, чтобы GC не съел задачи
+
+    @staticmethod
+    async def ignore_drop(upd, reason):
+        pass
+
+    async def submit(self, chat_id, upd):
+        q = self.chats.get(chat_id)
+        if q is not None and len(q) >= self.per_chat:
+            await self.on_drop(upd, "busy")
+            return False
+        await self.slots.acquire()
+        self.in_flight.add(upd["update_id"])
+        q = self.chats.get(chat_id)
+        if q is None:
+            self.chats[chat_id] = deque([upd])
+            task = asyncio.create_task(self._drain(chat_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            q.append(upd)
+        return True
+
+    def _grant(self):
+        while (picked := self.fair.pop()) is not None:
+            turn = picked[0]
+            # Задачу отменили, пока она ждала, — слот сразу свободен
+            if turn.done(): self.fair.done(True)
+            else: turn.set_result(None)
+
+    async def _drain(self, chat_id):
+        q = self.chats[chat_id]
+        while q:
+            upd = q[0]
+            # classify читает SQLite (ключи, состояние чата) — не в event loop
+            cost, shared = await asyncio.to_thread(self.classify, upd)
+            if shared:
+                turn = asyncio.get_running_loop().create_future()
+                self.fair.push(chat_id, turn, cost, True)
+                self._grant()
+                await turn
+            t = time.perf_counter()
+            try:
+                with tracing(upd, chat_id):
+                    try:
+                        if self.deadline and cost >= 1 and update_age(upd) > self.deadline:
+                            await self.on_drop(upd, "stale")
+                        else:
+                            await self.handler(upd)
+                        metrics.inc("tggb_updates_total", result="ok")
+                    except Exception as e:
+                        metrics.inc("tggb_updates_total", result="error")
+                        log(f"🛑 [WORKER ERROR] {e}")
+            finally:
+                metrics.observe("tggb_update_seconds", time.perf_counter() - t)
+                if shared:
+                    self.fair.done(True)
+                    self._grant()
+                q.popleft()
+                self.in_flight.discard(upd["update_id"])
+                self.slots.release()
+        del self.chats[chat_id]
+
+    def pending(self):
+        return len(self.in_flight)
+
+def queue_worker(engine, parent=None):
+    """Процесс-воркер общей очереди (QUEUE_WORKERS или BOT_ROLE=worker)"""
+    lifecycle.install()
+    if engine == "async":
+        asyncio.run(AsyncUltraGdzBot().run_worker(parent))
+    else:
+        bot = UltraGdzBot()
+        bot.warm()
+        bot.run_worker(parent)
+        bot.shutdown()
+    lifecycle.exit()
 
 if __name__ == "__main__":
+    engine = os.environ.get("BOT_ENGINE")
+    lifecycle.install()
+    if os.environ.get("BOT_ROLE") == "worker":
+        # Ещё одна реплика-воркер к уже работающему приёмщику (тот же QUEUE_DB)
+        if not os.environ.get("QUEUE_DB"): raise SystemExit("BOT_ROLE=worker требует QUEUE_DB")
+        queue_worker(engine)
+        raise SystemExit
     Thread(target=run_web, daemon=True).start()
-    UltimateGdzBot().run()
+    if os.environ.get("QUEUE_DB"):
+        ctx = multiprocessing.get_context("spawn")
+        for _ in range(int(os.environ.get("QUEUE_WORKERS", 0))):
+            p = ctx.Process(target=queue_worker, args=(engine, os.getpid()))
+            p.start()
+            lifecycle.children.append(p)
+    # BOT_ENGINE=async — asyncio-движок, по умолчанию потоки
+    if engine == "async":
+        bot = AsyncUltraGdzBot()
+        asyncio.run(bot.run_webhook() if WEBHOOK_URL else bot.run())
+    else:
+        bot = UltraGdzBot()
+        bot.run_webhook() if WEBHOOK_URL else bot.run()
+    # Воркеры получили SIGTERM вместе с нами и дренируют свои задачи
+    for p in lifecycle.children:
+        p.join(lifecycle.drain_timeout)
+    lifecycle.exit()